@@ -0,0 +1,179 @@
+#!/usr/bin/python
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""End-to-end throughput benchmark against simulated modems
+
+Runs the real SMSGateway with its spool and modem pool on a Unix
+socket, with every modem a bench/modemsim.py simulator, and delivers
+messages to it over LMTP from several concurrent clients. Reports
+messages per second and p50/p99 latency, both until the LMTP reply
+and until the last part reached a modem.
+
+    bench/gatewaybench.py --modems 2 --messages 200 --clients 8 --submit-latency 0.05
+"""
+
+from __future__ import print_function, unicode_literals
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from modemsim import ModemSimulator
+from lmtpsmsd.smsdevice import SMSDevice, SMSDevicePool
+from lmtpsmsd.smsgateway import SMSGateway
+from lmtpsmsd.spool import Spool
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class Bench():
+    def __init__(self, args):
+        self.args = args
+        self.sent = {}
+        self.accepted = {}
+        self.delivered = {}
+        self.parts = {}
+        self.done = None
+
+    def onsubmit(self, message):
+        # runs on a simulator thread
+        destination = message["destination"]
+        total = message["concatenation"][1] if message["concatenation"] else 1
+        self.parts[destination] = self.parts.get(destination, 0) + 1
+        if self.parts[destination] == total:
+            self.delivered[destination] = message["time"]
+            if len(self.delivered) == self.args.messages:
+                self.loop.call_soon_threadsafe(self.done.set)
+
+    async def client(self, path, numbers, body):
+        reader, writer = await asyncio.open_unix_connection(path)
+        await reader.readline()
+        writer.write(b"LHLO bench\r\n")
+        # multiline reply, up to "250 " without the dash
+        while (await reader.readline())[3:4] == b"-":
+            pass
+        for number in numbers:
+            writer.write("MAIL FROM:<bench@localhost>\r\nRCPT TO:<{}@sms>\r\nDATA\r\n".format(number).encode("ascii"))
+            for i in range(3):
+                await reader.readline()
+            self.sent[number] = time.time()
+            writer.write("From: bench@localhost\r\nSubject: bench\r\n\r\n{}\r\n.\r\n".format(body).encode("utf-8"))
+            status = await reader.readline()
+            if not status.startswith(b"250"):
+                print("{}: {}".format(number, status.decode("ascii", errors='replace').strip()))
+            self.accepted[number] = time.time()
+        writer.write(b"QUIT\r\n")
+        await reader.readline()
+        writer.close()
+
+    async def run(self):
+        args = self.args
+        self.loop = asyncio.get_running_loop()
+        self.done = asyncio.Event()
+        tmp = tempfile.mkdtemp(prefix="lmtpsmsd-bench-")
+
+        sims = []
+        devices = []
+        for i in range(args.modems):
+            sim = ModemSimulator(pin="1234", latency=args.latency, submit_latency=args.submit_latency,
+                                 error_rate=args.error_rate, drop_rate=args.drop_rate, seed=i)
+            sim.onsubmit = self.onsubmit
+            sims.append(sim.start())
+            serialconf = {"device": sim.path, "speed": "115200", "timeout": str(args.timeout)}
+            devices.append(SMSDevice(serialconf, {"pin": "1234"}, name="sim{}".format(i)))
+        smsdevices = SMSDevicePool(devices)
+
+        path = os.path.join(tmp, "lmtp")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        spool = Spool({"directory": os.path.join(tmp, "spool")})
+        gateway = SMSGateway(smsdevices, spool, sock)
+        # the daemon's order: listen first, bring up the modems alongside
+        starting = time.perf_counter()
+        await gateway.start()
+        connecting = asyncio.ensure_future(smsdevices.connect())
+        connecting.add_done_callback(lambda f: setattr(self, "connected", time.perf_counter()))
+        reader, writer = await asyncio.open_unix_connection(path)
+        await reader.readline()
+        greeted = time.perf_counter()
+        writer.close()
+
+        body = ("bench " * (args.length // 6 + 1))[:args.length]
+        numbers = ["+4670{:07d}".format(i) for i in range(args.messages)]
+        started = time.time()
+        await asyncio.gather(*[self.client(path, numbers[i::args.clients], body) for i in range(args.clients)])
+        accepted = time.time()
+        try:
+            await asyncio.wait_for(self.done.wait(), timeout=args.deadline)
+        except asyncio.TimeoutError:
+            print("only {} of {} messages delivered".format(len(self.delivered), args.messages))
+        finished = time.time()
+
+        lmtp = [self.accepted[n] - self.sent[n] for n in self.accepted]
+        endtoend = [self.delivered[n] - self.sent[n] for n in self.delivered]
+        commands = sum(sim.commands for sim in sims)
+        await connecting
+        print("modems {}, clients {}, messages {}, {} septets".format(args.modems, args.clients, args.messages, args.length))
+        print("first LMTP greeting after {:.1f} ms, modems ready after {:.1f} ms".format(
+            (greeted - starting) * 1000, (self.connected - starting) * 1000))
+        print("accepted {:.1f} msg/s, delivered {:.1f} msg/s".format(
+            len(lmtp) / (accepted - started), len(endtoend) / (finished - started)))
+        print("LMTP latency  p50 {:.1f} ms  p99 {:.1f} ms".format(percentile(lmtp, 0.5) * 1000, percentile(lmtp, 0.99) * 1000))
+        print("end to end    p50 {:.1f} ms  p99 {:.1f} ms".format(percentile(endtoend, 0.5) * 1000, percentile(endtoend, 0.99) * 1000))
+        print("AT commands per message {:.2f}".format(commands / max(1, len(endtoend))))
+        smsdevices.disconnect()
+        for sim in sims:
+            sim.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="lmtpsmsd end-to-end benchmark")
+    parser.add_argument("--modems", type=int, default=1)
+    parser.add_argument("--clients", type=int, default=4, help="concurrent LMTP connections")
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--length", type=int, default=100, help="message body length")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated seconds per AT command")
+    parser.add_argument("--submit-latency", type=float, default=0.0, help="simulated seconds per AT+CMGS")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--timeout", type=int, default=1, help="serial read timeout")
+    parser.add_argument("--deadline", type=float, default=300.0, help="seconds to wait for delivery")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    asyncio.run(Bench(args).run())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/python
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""GSM modem simulator on a pseudo-terminal
+
+Answers the AT subset lmtpsmsd uses and decodes every submitted PDU,
+so the daemon can be run and load tested without a SIM card.
+
+    bench/modemsim.py --link /tmp/modem0 --latency 0.01 --submit-latency 0.5
+
+then point device in [serial] at /tmp/modem0.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import os
+import time
+import tty
+import random
+import select
+import argparse
+import threading
+
+import smsutil
+
+def unpack_septets(octets, count, fillbits=0):
+    value = int.from_bytes(octets, "little") >> fillbits
+    return bytes((value >> (7 * i)) & 0x7F for i in range(count))
+
+def decode_semi_octets(octets, digits):
+    swapped = "".join("{:X}{:X}".format(octet & 0x0F, octet >> 4) for octet in octets)
+    return swapped[:digits]
+
+def decode_submit(hexpdu):
+    """Decode an SMS-SUBMIT PDU as sent by AT+CMGS in PDU mode"""
+    pdu = bytes.fromhex(hexpdu)
+    i = 1 + pdu[0]
+    first = pdu[i]
+    udhi = bool(first & 0x40)
+    i += 2
+    digits = pdu[i]
+    numtype = pdu[i + 1]
+    i += 2
+    numberlength = (digits + 1) // 2
+    destination = decode_semi_octets(pdu[i:i + numberlength], digits)
+    if numtype == 0x91:
+        destination = "+" + destination
+    i += numberlength
+    dcs = pdu[i + 1]
+    udl = pdu[i + 2]
+    ud = pdu[i + 3:]
+    header = None
+    if dcs & 0x0C == 0x08:
+        # UCS-2, UDL counts octets
+        if udhi:
+            header = ud[1:1 + ud[0]]
+            ud = ud[1 + ud[0]:]
+        text = ud[:udl - (len(header) + 1 if header is not None else 0)].decode("utf_16_be")
+    else:
+        skip = 0
+        fillbits = 0
+        if udhi:
+            header = ud[1:1 + ud[0]]
+            headerbits = (1 + ud[0]) * 8
+            skip = (headerbits + 6) // 7
+            fillbits = skip * 7 - headerbits
+            ud = ud[1 + ud[0]:]
+        text = smsutil.decode(unpack_septets(ud, udl - skip, fillbits))
+    concatenation = None
+    if header is not None and len(header) >= 5 and header[0] == 0x00:
+        concatenation = (header[2], header[3], header[4])
+    return {"destination": destination, "text": text, "concatenation": concatenation, "dcs": dcs}
+
+class ModemSimulator():
+    def __init__(self, pin=None, latency=0.0, submit_latency=0.0, error_rate=0.0, drop_rate=0.0, echo=False, seed=None):
+        self.pin = pin
+        self.pin_ok = pin is None
+        self.latency = latency
+        self.submit_latency = submit_latency
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.echo = echo
+        self.random = random.Random(seed)
+        self.reference = 0
+        self.speed = 115200
+        self.pdumode = False
+        # network registration, +CREG/+CEREG report mode, and AT+CSQ <rssi>
+        self.registered = True
+        self.reports = {"+CREG": 0, "+CEREG": 0}
+        self.rssi = 20
+        self.submitted = []
+        self.commands = 0
+        self.onsubmit = None
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        self.path = os.ttyname(self.slave)
+        self.link = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.running = True
+
+    def start(self, link=None):
+        if link is not None:
+            if os.path.lexists(link):
+                os.unlink(link)
+            os.symlink(self.path, link)
+            self.link = link
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.link is not None and os.path.lexists(self.link):
+            os.unlink(self.link)
+
+    def reply(self, *lines):
+        if self.drop_rate and self.random.random() < self.drop_rate:
+            return
+        os.write(self.master, b"".join(b"\r\n" + line.encode("ascii") + b"\r\n" for line in lines))
+
+    def set_registered(self, registered):
+        """Gain or lose the network, with the unsolicited reports enabled"""
+        self.registered = registered
+        for report, mode in self.reports.items():
+            if mode:
+                self.reply("{}: {}".format(report, 1 if registered else 2))
+
+    def run(self):
+        buf = b""
+        pdu = None
+        while self.running:
+            ready, w, x = select.select([self.master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                return
+            if self.echo:
+                os.write(self.master, data)
+            buf += data
+            while True:
+                if pdu is not None:
+                    end = buf.find(b"\x1a")
+                    if end < 0:
+                        break
+                    hexpdu = buf[:end].decode("ascii", errors='ignore').strip()
+                    buf = buf[end + 1:]
+                    pdu = None
+                    self.submit(hexpdu)
+                    continue
+                end = buf.find(b"\r")
+                if end < 0:
+                    break
+                line = buf[:end].decode("ascii", errors='ignore').strip().strip("\x1a")
+                buf = buf[end + 1:]
+                if line:
+                    pdu = self.command(line)
+
+    def command(self, line):
+        """Answer one command line, returns True when a PDU is to follow"""
+        self.commands += 1
+        if self.latency:
+            time.sleep(self.latency)
+        cmd = line.upper()
+        if not cmd.startswith("AT"):
+            self.reply("ERROR")
+        elif cmd in ("AT", "ATE0", "ATE1", "ATZ"):
+            if cmd == "ATE0":
+                self.echo = False
+            elif cmd == "ATE1":
+                self.echo = True
+            self.reply("OK")
+        elif cmd == "AT+IPR?":
+            self.reply("+IPR: {}".format(self.speed), "OK")
+        elif cmd.startswith("AT+IPR="):
+            self.speed = int(cmd[7:])
+            self.reply("OK")
+        elif cmd == "AT+CPIN?":
+            self.reply("+CPIN: {}".format("READY" if self.pin_ok else "SIM PIN"), "OK")
+        elif cmd.startswith("AT+CPIN="):
+            if line[8:].strip('"') == self.pin:
+                self.pin_ok = True
+                self.reply("OK")
+            else:
+                self.reply("+CME ERROR: 16")
+        elif cmd.startswith("AT+CMGF="):
+            self.pdumode = cmd[8:] == "0"
+            self.reply("OK")
+        elif cmd.startswith("AT+CMMS=") or cmd.startswith("AT+CMEE="):
+            self.reply("OK")
+        elif cmd.startswith("AT+CREG") or cmd.startswith("AT+CEREG"):
+            report = cmd[2:].split("=")[0].rstrip("?")
+            if cmd.endswith("?"):
+                self.reply("{}: {},{}".format(report, self.reports[report], 1 if self.registered else 2), "OK")
+            else:
+                self.reports[report] = int(cmd.split("=")[1])
+                self.reply("OK")
+        elif cmd == "AT+CSQ":
+            self.reply("+CSQ: {},99".format(self.rssi if self.registered else 99), "OK")
+        elif cmd.startswith("AT+CMGS="):
+            if not (self.pdumode and self.pin_ok):
+                self.reply("+CMS ERROR: 302")
+                return None
+            if not self.registered:
+                self.reply("+CMS ERROR: 331")
+                return None
+            os.write(self.master, b"\r\n> ")
+            return True
+        else:
+            self.reply("ERROR")
+        return None
+
+    def submit(self, hexpdu):
+        if self.submit_latency:
+            time.sleep(self.submit_latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.reply("+CMS ERROR: 500")
+            return
+        try:
+            message = decode_submit(hexpdu)
+        except Exception:
+            self.reply("+CMS ERROR: 304")
+            return
+        self.reference = (self.reference + 1) % 256
+        message["time"] = time.time()
+        message["pdu"] = hexpdu
+        self.submitted.append(message)
+        if self.onsubmit is not None:
+            self.onsubmit(message)
+        self.reply("+CMGS: {}".format(self.reference), "OK")
+
+def main():
+    parser = argparse.ArgumentParser(description="GSM modem simulator on a pty")
+    parser.add_argument("--link", help="symlink to create to the pty")
+    parser.add_argument("--pin", help="require this PIN")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before answering a command")
+    parser.add_argument("--submit-latency", type=float, default=0.0, help="seconds for the network to accept an SMS")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of submissions answered with +CMS ERROR")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="fraction of responses never sent")
+    parser.add_argument("--echo", action="store_true", help="start with command echo on")
+    args = parser.parse_args()
+
+    sim = ModemSimulator(pin=args.pin, latency=args.latency, submit_latency=args.submit_latency,
+                         error_rate=args.error_rate, drop_rate=args.drop_rate, echo=args.echo)
+    sim.onsubmit = lambda message: print("{destination} {concatenation} {text!r}".format(**message), flush=True)
+    sim.start(args.link)
+    print("modem at {}".format(args.link or sim.path), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        sim.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/python
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Micro-benchmarks for the PDU encoder in lmtpsmsd._private.pdu
+
+Before timing anything the encoder is checked against the golden corpus
+in pdu_golden.jsonl, which it must reproduce byte for byte. Each case
+is timed cold, with the destination and body caches off so the encoder
+itself is measured, and warm, as the gateway runs with repeated texts.
+
+    bench/pdubench.py                 check the corpus and run the benchmarks
+    bench/pdubench.py --write-golden  regenerate the corpus (only when the
+                                      PDU format is meant to change)
+"""
+
+from __future__ import print_function, unicode_literals
+
+import os
+import sys
+import json
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lmtpsmsd._private import pdu
+from lmtpsmsd._private.pdu import TextMessage
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pdu_golden.jsonl")
+
+class FixedReferences:
+    """Concatenation references that don't depend on history or chance"""
+    def next(self, destination):
+        return 0x42
+
+DESTINATIONS = ["+46701234567", "0701234567", "+4687906000", "112", "+1"]
+
+ALPHABET = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 .,:;!?@£$¥èéùìòÇØøÅåÆæßÉÄÖÑÜ§äöñüà\n"
+
+def body(septets, offset=0):
+    return "".join(ALPHABET[(i + offset) % len(ALPHABET)] for i in range(septets))
+
+def corpus():
+    for destination in DESTINATIONS:
+        for septets in list(range(1, 17)) + [39, 40, 41, 80, 127, 152, 153, 154, 159, 160]:
+            yield destination, body(septets, len(destination))
+    extension = "€[]{}|^~\\"
+    for septets in [1, 2, 3, 79, 80, 81, 152, 153]:
+        yield "+46701234567", (extension * 40)[:septets]
+        yield "+46701234567", body(septets) + extension
+    for septets in [161, 306, 307, 460, 700]:
+        yield "+46701234567", body(septets)
+        yield "0701234567", body(septets, 7)
+
+def encode(destination, message):
+    return [(p.hex(), p.tpdu_octet_length()) for p in TextMessage(destination, message, references=FixedReferences()).parts()]
+
+def write_golden():
+    with open(GOLDEN, "w") as f:
+        for destination, message in corpus():
+            record = {"destination": destination, "message": message, "pdus": encode(destination, message)}
+            f.write(json.dumps(record) + "\n")
+
+def check_golden():
+    failures = 0
+    count = 0
+    with open(GOLDEN) as f:
+        for line in f:
+            record = json.loads(line)
+            expected = [(bytes.fromhex(h), l) for h, l in record["pdus"]]
+            actual = [(bytes.fromhex(h), l) for h, l in encode(record["destination"], record["message"])]
+            count += 1
+            if actual != expected:
+                failures += 1
+                print("MISMATCH {} {!r}".format(record["destination"], record["message"]))
+    print("golden corpus: {} messages, {} mismatches".format(count, failures))
+    return failures == 0
+
+def best(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+def bench(name, fn, number):
+    """Microseconds per call of fn, with the caches off and on"""
+    pdu.configure_caches({"destinations": 0, "bodies": 0})
+    cold = best(fn, number)
+    pdu.configure_caches({})
+    warm = best(fn, number)
+    print("{:<28} {:>10.1f} us {:>10.1f} us".format(name, cold, warm))
+
+def run_benchmarks(number):
+    print("{:<28} {:>13} {:>13}".format("", "cold", "warm"))
+    for septets in [1, 10, 40, 80, 120, 160]:
+        message = body(septets)
+        bench("encode {} septets".format(septets), lambda: encode("+46701234567", message), number)
+    for septets in [306, 700]:
+        message = body(septets)
+        bench("encode {} septets".format(septets), lambda: encode("+46701234567", message), number // 4)
+    for recipients in [10, 100]:
+        message = body(160)
+        destinations = ["+467012{:05d}".format(i) for i in range(recipients)]
+        def fanout():
+            for destination in destinations:
+                encode(destination, message)
+        bench("fan-out 160 septets x {}".format(recipients), fanout, max(1, number // recipients))
+
+def main():
+    parser = argparse.ArgumentParser(description="PDU encoder benchmarks")
+    parser.add_argument("--write-golden", action="store_true", help="regenerate the golden corpus")
+    parser.add_argument("--number", type=int, default=2000, help="iterations per measurement")
+    args = parser.parse_args()
+
+    if args.write_golden:
+        write_golden()
+        return
+    if not check_golden():
+        sys.exit(1)
+    run_benchmarks(args.number)
+
+if __name__ == '__main__':
+    main()
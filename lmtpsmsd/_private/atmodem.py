@@ -24,81 +24,288 @@
 
 from __future__ import print_function, unicode_literals
 
+import collections
+import logging
+import time
+
 from .debugserial import DebugLockingSerial
+from . import metrics
+from .atresponse import ATResponseParser, FINAL, INTERMEDIATE, UNSOLICITED, PROMPT
+from .modemstate import ModemState, NetworkState, NotRegistered, MessageRejected
+from .commandtimeouts import CommandTimeouts, commandtype
+
+# +CMS ERROR codes for no network service and network timeout, numeric
+# and verbose
+NO_NETWORK = ("+CMS ERROR: 331", "+CMS ERROR: 332", "+CMS ERROR: no network service", "+CMS ERROR: network timeout")
 
 class ATSerial(DebugLockingSerial):
+    def __init__(self, *args, state=None, network=None, timeouts=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.parser = ATResponseParser()
+        self.events = collections.deque()
+        self.atlogger = logging.getLogger("atmodem")
+        self.state = state if state is not None else ModemState()
+        self.network = network if network is not None else NetworkState()
+        self.timeouts = timeouts if timeouts is not None else CommandTimeouts()
+
     def reset(self):
+        self.state.invalidate()
         self.write(b'\x1a')
         self.flush()
         self.write(b'\r')
         self.flush()
 
+    def probe(self, attempts=20, interval=0.1):
+        """Wake the modem from whatever it was doing and wait until it
+        answers AT, rather than for a fixed time"""
+        self.reset()
+        for attempt in range(attempts):
+            self.discard()
+            self.send("AT")
+            final, intermediates = self.response(time.monotonic() + interval)
+            if final == "OK":
+                # a slow modem still owes answers to the earlier ones
+                self.drainlate(attempt, time.monotonic() + self.timeouts["AT"].timeout)
+                return attempt + 1
+        raise Exception("No response from modem")
+
     def send(self, s):
         self.write("{}\r".format(s).encode("ascii"))
         self.flush()
 
-    def waitforbuf(self, f, prev=b'', completeline=True, tries=4):
-        if tries == 0:
-            return None
-        c = self.readlinebytes() if completeline else self.read()
-        buf = prev if (c is None) else prev + c
-        new_tries = tries-1 if completeline else tries if len(c) > 0 else tries-1
-        if len(buf) > 0 and (buf[-1] == 10 or not completeline):
-            s = None
-            try:
-                s = buf.decode("ascii", errors='ignore')
-            except:
-                pass
-            if s is not None:
-                lines = s.splitlines()
-                for l in lines:
-                    res = f(l)
-                    if res:
-                        return res
-        return self.waitforbuf(f, prev=buf, completeline=completeline, tries=new_tries)
-
-    def command(self, commandstring, tries=3):
-        if tries == 0:
-            raise Exception("No response from modem")
-        self.send(commandstring)
-        res = self.waitforbuf(lambda s: s if (s == "OK") else None)
-        if res:
-            return res
-        self.command(commandstring, tries=tries-1)
+    def unsolicited(self, event):
+        if self.network.update(event.text):
+            self.atlogger.info("Network: {}".format(self.network.describe()))
+        else:
+            self.atlogger.info("Unsolicited: {}".format(event.text))
+
+    def nextevent(self, deadline):
+        """The next solicited event, or None once the monotonic clock
+        passes deadline without one"""
+        while True:
+            while self.events:
+                event = self.events.popleft()
+                if event.kind == UNSOLICITED:
+                    self.unsolicited(event)
+                    continue
+                if event.kind == FINAL and event.text.startswith("+CME ERROR:"):
+                    self.state.invalidate()
+                return event
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self.events.extend(self.parser.feed(self.readavailable(remaining)))
+
+    def discard(self):
+        """Drop leftovers of earlier commands before sending a new one"""
+        if self.in_waiting:
+            self.events.extend(self.parser.feed(self.read(self.in_waiting)))
+        while self.events:
+            event = self.events.popleft()
+            if event.kind == UNSOLICITED:
+                self.unsolicited(event)
+            else:
+                self.atlogger.debug("Discarding: {}".format(event.text))
+
+    def response(self, deadline):
+        """Intermediate responses up to the final result code, which is
+        None if it did not come before deadline"""
+        intermediates = []
+        while True:
+            event = self.nextevent(deadline)
+            if event is None:
+                return None, intermediates
+            if event.kind == FINAL:
+                return event.text, intermediates
+            if event.kind == INTERMEDIATE:
+                intermediates.append(event.text)
+
+    def drainlate(self, count, deadline):
+        """Drops up to count answers still owed to commands that were
+        sent again, so none is taken for the answer to the next command.
+        The earlier sends may also have been lost, so running out of
+        time here says nothing about the modem."""
+        for late in range(count):
+            if self.response(deadline)[0] is None:
+                break
+
+    def command(self, commandstring, prefixes=(), retry=True):
+        """Returns the intermediate responses, raises unless the modem says OK
+
+        The response is waited for until the deadline of the command
+        type. With retry, a command that got no response at all is sent
+        once more, and whichever answer comes first is taken, so only
+        commands that can safely run twice may retry. Error results are
+        never retried. The time of a retried command is not measured,
+        since it is unknown which send the answer belongs to.
+        """
+        estimate = self.timeouts[commandtype(commandstring)]
+        for attempt in range(2 if retry else 1):
+            self.discard()
+            self.parser.expect(prefixes)
+            started = time.monotonic()
+            self.send(commandstring)
+            final, intermediates = self.response(started + estimate.timeout)
+            if final is None:
+                self.atlogger.warning("{}: no response in {:.1f} s".format(commandstring, estimate.timeout))
+                metrics.timeouts.inc()
+                estimate.timedout()
+                continue
+            if attempt == 0:
+                estimate.observe(time.monotonic() - started)
+            else:
+                self.drainlate(1, time.monotonic() + estimate.timeout)
+            if final == "OK":
+                return intermediates
+            raise Exception("{}: {}".format(commandstring, final))
+        raise Exception("No response from modem")
 
     def ping(self):
         self.command("AT")
 
     def checkspeed(self):
-        self.command("AT+IPR?")
+        return self.command("AT+IPR?", prefixes=("+IPR:",))
 
     def setspeed(self, speed):
+        if self.state.speed == str(speed):
+            return
         self.command("AT+IPR={}".format(speed))
+        self.state.speed = str(speed)
+
+    def seterrorreporting(self, level):
+        """AT+CMEE, 1 for numeric +CME ERROR codes"""
+        if self.state.errorreporting == str(level):
+            return
+        self.command("AT+CMEE={}".format(level))
+        self.state.errorreporting = str(level)
+
+    def setpdumode(self):
+        if self.state.pdumode:
+            return
+        self.command("AT+CMGF=0", retry=False)
+        self.state.pdumode = True
+
+    def enablenetworkreports(self):
+        """Unsolicited +CREG and, where the modem has LTE, +CEREG reports"""
+        if self.state.networkreports:
+            return
+        self.command("AT+CREG=1")
+        reports = ["+CREG"]
+        try:
+            self.command("AT+CEREG=1", retry=False)
+            reports.append("+CEREG")
+        except Exception:
+            pass
+        self.state.networkreports = tuple(reports)
+
+    def networkstatus(self):
+        for report in self.state.networkreports or ("+CREG",):
+            for line in self.command("AT{}?".format(report), prefixes=(report + ":",)):
+                self.network.update(line)
+        return self.network.registered()
+
+    def signalquality(self):
+        for line in self.command("AT+CSQ", prefixes=("+CSQ:",)):
+            self.network.update(line)
+        return self.network.dbm()
+
+    def poll(self):
+        """A keepalive that also refreshes registration and signal"""
+        self.signalquality()
+        if self.networkstatus() is False and not self.pinstatus():
+            # reset or replugged, it will not register before the PIN
+            self.state.invalidate()
+            raise Exception("SIM is locked")
 
     def pinstatus(self):
-        self.send("AT+CPIN?")
-        res = self.waitforbuf(lambda s: s if (s.startswith("+CPIN:")) else None, tries=8)
-        if res is None:
+        res = [line for line in self.command("AT+CPIN?", prefixes=("+CPIN:",)) if line.startswith("+CPIN:")]
+        if not res:
             raise Exception("Could not get PIN status")
-        return ("READY" in res)
+        return ("READY" in res[0])
 
     def sendpin(self, pin):
-        self.send("AT+CPIN={}".format(pin))
-        res = self.waitforbuf(lambda s: s if (s == "OK") else None)
-        if not res:
+        try:
+            self.command("AT+CPIN={}".format(pin), retry=False)
+        except Exception:
             raise Exception("Could not send PIN")
 
-    def sendpdusms(self, pdumessage):
-        self.command("AT+CMGF=0", tries=1)
+    def keeplinkopen(self):
+        # AT+CMMS=1 keeps the relay link to the SMSC open between the
+        # parts of a concatenated message, not all modems support it.
+        try:
+            self.command("AT+CMMS=1", retry=False)
+        except Exception:
+            pass
+
+    def submit(self, pdumessage):
+        with metrics.submit_seconds.time():
+            return self.submit_pdu(pdumessage)
+
+    def submit_pdu(self, pdumessage):
+        """Never retried here, a part that may or may not have gone out
+        is up to the spool"""
+        prompt = self.timeouts["AT+CMGS prompt"]
+        submit = self.timeouts["AT+CMGS submit"]
+        self.discard()
+        self.parser.expect(("+CMGS:",))
+        started = time.monotonic()
         self.send('AT+CMGS={}'.format(pdumessage.tpdu_octet_length()))
-        if not self.waitforbuf((lambda s: s if (s.startswith("> ")) else None), completeline=False, tries=30):
-            raise Exception("Cannot initiate submitting SMS.")
+        event = self.nextevent(started + prompt.timeout)
+        if event is None:
+            metrics.timeouts.inc()
+            prompt.timedout()
+            # the prompt may only have been lost, with the modem still
+            # waiting for a PDU, so the next connect has to probe
+            self.state.invalidate()
+        else:
+            prompt.observe(time.monotonic() - started)
+        if event is not None and event.text in NO_NETWORK:
+            self.network.lost()
+            raise NotRegistered("Cannot initiate submitting SMS: {}".format(event.text))
+        if event is None or event.kind != PROMPT:
+            raise Exception("Cannot initiate submitting SMS: {}".format(event.text if event else "no prompt"))
         self.write(pdumessage.hex().encode("ascii"))
         self.write(b'\x1a\r')
         self.flush()
-        if not self.waitforbuf(lambda s: s if (s.startswith("+CMGS:")) else None):
-            raise Exception("No response after submitting SMS.")
+        started = time.monotonic()
+        final, intermediates = self.response(started + submit.timeout)
+        if final is None:
+            metrics.timeouts.inc()
+            submit.timedout()
+        else:
+            submit.observe(time.monotonic() - started)
+        # with echo on the PDU itself comes back before +CMGS:
+        references = [line for line in intermediates if line.startswith("+CMGS:")]
+        if final in NO_NETWORK:
+            self.network.lost()
+            raise NotRegistered("Submitting SMS failed: {}".format(final))
+        if final is not None and final.startswith("+CMS ERROR:"):
+            raise MessageRejected("Submitting SMS failed: {}".format(final))
+        if final != "OK" or not references:
+            raise Exception("No response after submitting SMS: {}".format(final))
+        return references[0]
+
+    def sendpdusms(self, pdumessages, onsent=None):
+        """Submit all PDUs in one session, onsent(i) is called as each part
+        is accepted and ends the session early if it returns False"""
+        # registration reports that came in since the last session
+        self.discard()
+        if self.network.registered() is False:
+            raise NotRegistered("Not registered with the network")
+        self.setpdumode()
+        if len(pdumessages) > 1:
+            self.keeplinkopen()
+        for i, pdumessage in enumerate(pdumessages):
+            self.submit(pdumessage)
+            if onsent is not None and onsent(i) is False:
+                return
 
     def auth(self, pin):
+        """Asks on every connect, a SIM that was swapped or reset needs
+        its PIN again whatever the state says"""
         if not self.pinstatus():
+            # a SIM asking again went through a reset, and so did
+            # whatever else was set up
+            self.state.invalidate()
             self.sendpin(pin)
+        self.state.pinready = True
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+import collections
+
+FINAL = "final"
+INTERMEDIATE = "intermediate"
+UNSOLICITED = "unsolicited"
+PROMPT = "prompt"
+
+ATEvent = collections.namedtuple("ATEvent", ["kind", "text"])
+
+FINAL_RESULTS = ("OK", "ERROR", "NO CARRIER", "NO DIALTONE", "BUSY", "NO ANSWER")
+FINAL_PREFIXES = ("+CME ERROR:", "+CMS ERROR:")
+UNSOLICITED_RESULTS = ("RING",)
+
+class ATResponseParser():
+    """Incremental parser turning modem output into events
+
+    Bytes are fed in as they arrive. Complete lines come out as final
+    result codes, intermediate responses to the running command (lines
+    with one of the prefixes it expects, or unprefixed text), or
+    unsolicited result codes. The "> " prompt of AT+CMGS is an event
+    of its own since no line ending follows it.
+    """
+    def __init__(self):
+        self.buf = bytearray()
+        self.prefixes = ()
+
+    def expect(self, prefixes=()):
+        """Prefixes of the intermediate responses of the next command"""
+        self.prefixes = tuple(prefixes)
+
+    def classify(self, line):
+        if line in FINAL_RESULTS or line.startswith(FINAL_PREFIXES):
+            return ATEvent(FINAL, line)
+        if self.prefixes and line.startswith(self.prefixes):
+            return ATEvent(INTERMEDIATE, line)
+        if line.startswith("+") or line in UNSOLICITED_RESULTS:
+            return ATEvent(UNSOLICITED, line)
+        if line[:2].upper() == "AT":
+            # command echo
+            return None
+        return ATEvent(INTERMEDIATE, line)
+
+    def feed(self, data):
+        """Returns the events completed by data"""
+        self.buf += data
+        events = []
+        start = 0
+        buf = self.buf
+        end = len(buf)
+        while start < end:
+            if buf[start] in b"\r\n":
+                start += 1
+                continue
+            if buf[start:start + 2] == b"> ":
+                events.append(ATEvent(PROMPT, "> "))
+                start += 2
+                continue
+            newline = buf.find(b"\n", start)
+            if newline < 0:
+                break
+            line = bytes(buf[start:newline]).decode("ascii", errors='ignore').strip()
+            start = newline + 1
+            if line:
+                event = self.classify(line)
+                if event is not None:
+                    events.append(event)
+        del buf[:start]
+        return events
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+# (initial, minimum, maximum) seconds per kind of wait, the initial one
+# applies until there is a measurement. The AT+CMGS prompt and the
+# network's acceptance of a PDU have their own, every other command
+# type starts out with the default.
+DEFAULT = (3.0, 1.0, 15.0)
+LIMITS = {
+    "AT+CMGS prompt": (5.0, 1.0, 30.0),
+    # a part given up on is sent again, so a slow network must never
+    # look like a lost answer: the floor is well above the 12 seconds
+    # that were waited before these deadlines
+    "AT+CMGS submit": (60.0, 30.0, 120.0),
+    # the SIM may take seconds to check a PIN
+    "AT+CPIN=": (10.0, 2.0, 30.0),
+}
+
+# the gains and variance factor of RFC 6298
+ALPHA = 1 / 8
+BETA = 1 / 4
+K = 4
+# floor on the variance term, serial reads are not finer than this
+GRANULARITY = 0.1
+
+def commandtype(commandstring):
+    """AT+CREG? and AT+CREG=1 are different types, the arguments are not"""
+    for i, c in enumerate(commandstring):
+        if c in "=?":
+            return commandstring[:i + 1]
+    return commandstring
+
+class LatencyEstimate():
+    """Smoothed response time and its variation, with the deadline
+    derived from them the way TCP derives its retransmission timeout"""
+    def __init__(self, initial, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.srtt = None
+        self.rttvar = None
+        self.timeout = initial
+
+    def observe(self, seconds):
+        if self.srtt is None:
+            self.srtt = seconds
+            self.rttvar = seconds / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - seconds)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * seconds
+        self.timeout = min(self.maximum, max(self.minimum, self.srtt + max(GRANULARITY, K * self.rttvar)))
+
+    def timedout(self):
+        """Back off, the next measurement brings the deadline down again"""
+        self.timeout = min(self.maximum, 2 * self.timeout)
+
+class CommandTimeouts():
+    """A LatencyEstimate per command type, kept by SMSDevice across
+    reconnects of the same modem"""
+    def __init__(self):
+        self.estimates = {}
+
+    def __getitem__(self, kind):
+        estimate = self.estimates.get(kind)
+        if estimate is None:
+            estimate = self.estimates[kind] = LatencyEstimate(*LIMITS.get(kind, DEFAULT))
+        return estimate
+
+    def items(self):
+        return list(self.estimates.items())
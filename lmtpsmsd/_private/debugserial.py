@@ -25,9 +25,12 @@
 from __future__ import print_function, unicode_literals
 
 import logging
+import select
 import serial
 import fcntl
 
+from .wiretrace import TX, RX
+
 class LockingSerial(serial.Serial):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -40,34 +43,63 @@ class LockingSerial(serial.Serial):
         fcntl.lockf(self.fd, fcntl.LOCK_UN)
         super().__exit__(*args, **kwargs)
 
+    def acquire(self, blocking=True):
+        """Take the lock again after release(), False if blocking is off
+        and another process has it"""
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (BlockingIOError, PermissionError):
+            return False
+        return True
+
+    def release(self):
+        """Let other processes use the device while the port stays open"""
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
 class DebugLockingSerial(LockingSerial):
-    def __init__(self, *args, **kwargs):
+    """Logs serial I/O at DEBUG level and records it in an optional WireTrace
+
+    Both are checked before anything is formatted or copied, so a
+    disabled trace costs an attribute test per call.
+    """
+    def __init__(self, *args, trace=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.logger = logging.getLogger("serial")
+        self.trace = trace
 
     def write(self, bytearray, *args, **kwargs):
-        self.logger.debug("Write: {}".format(bytearray))
+        if self.trace is not None:
+            self.trace.record(TX, bytearray)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Write: {}".format(bytearray))
         super().write(bytearray, *args, **kwargs)
 
     def flush(self, *args, **kwargs):
-        self.logger.debug("Flush")
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Flush")
         super().flush(*args, **kwargs)
 
     def read(self, *args, **kwargs):
         res = super().read(*args, **kwargs)
-        self.logger.debug("Read: {}".format(res))
+        if res and self.trace is not None:
+            self.trace.record(RX, res)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Read: {}".format(res))
         return res
 
-    def _readlinebytes(self):
-        c = super().read()
-        if c is None or len(c) == 0:
-            return b''
-        if c[-1] == 10:
-            return c
-        return c + self._readlinebytes()
-
-    def readlinebytes(self):
-        res = self._readlinebytes()
-        self.logger.debug("Read: {}".format(res))
+    def readavailable(self, timeout=None):
+        """Waits up to timeout seconds, or the port's timeout, for a
+        byte, then takes whatever else has arrived"""
+        if timeout is not None and not select.select([self.fd], [], [], max(0, timeout))[0]:
+            res = b''
+        else:
+            res = super().read(1)
+        if res:
+            waiting = self.in_waiting
+            if waiting:
+                res += super().read(waiting)
+            if self.trace is not None:
+                self.trace.record(RX, res)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Read: {}".format(res))
         return res
-
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+import os
+import re
+import mmap
+import struct
+import hashlib
+import logging
+
+# Source format, one entry per line:
+#
+#   alice: +46701234567, +46707654321
+#   oncall: alice, bob, +46708888888
+#
+# An entry lists numbers and names of other entries, so groups can hold
+# people and other groups. The compiled index maps every name straight
+# to its numbers:
+#
+#   header   magic, version, slot count, entry count
+#   slots    (64 bit hash of the name, offset of its record) each,
+#            open addressing with linear probing, offset 0 is empty
+#   records  name length, name, number count, (length, number) each
+
+MAGIC = b"LSDI"
+VERSION = 1
+HEADER = struct.Struct("<4sIII")
+SLOT = struct.Struct("<QI")
+NUMBER = re.compile(r"^\+?[0-9]+$")
+
+def namehash(name):
+    return int.from_bytes(hashlib.blake2b(name, digest_size=8).digest(), "little")
+
+def parse(path):
+    """{name: [numbers and names]} from the source file"""
+    entries = {}
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, start=1):
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            name, colon, members = line.partition(":")
+            name = name.strip().lower()
+            if not colon or not name:
+                raise ValueError("{}:{}: expected name: members".format(path, lineno))
+            entries.setdefault(name, []).extend(m.strip() for m in members.replace(",", " ").split())
+    return entries
+
+def resolve(entries, logger):
+    """{name: [numbers]}, groups flattened in order without duplicates"""
+    for name, members in entries.items():
+        for member in members:
+            if not NUMBER.match(member) and member.lower() not in entries:
+                logger.warning("{} in {} is neither a number nor an entry".format(member, name))
+    resolved = {}
+    for name in entries:
+        numbers = []
+        seen = set()
+        visited = {name}
+        def walk(group):
+            for member in entries[group]:
+                if NUMBER.match(member):
+                    candidates = [member]
+                elif member.lower() in resolved:
+                    candidates = resolved[member.lower()]
+                elif member.lower() in entries and member.lower() not in visited:
+                    # groups that hold each other end up with the same numbers
+                    visited.add(member.lower())
+                    walk(member.lower())
+                    continue
+                else:
+                    continue
+                for number in candidates:
+                    if number not in seen:
+                        seen.add(number)
+                        numbers.append(number)
+        walk(name)
+        resolved[name] = numbers
+    return resolved
+
+def build(source, index, logger=None):
+    """Writes the index for source next to its final path and renames it
+    into place, so readers never see half of it"""
+    logger = logger or logging.getLogger("directory")
+    resolved = resolve(parse(source), logger)
+    nslots = 1
+    while nslots < 2 * len(resolved):
+        nslots *= 2
+    slots = [(0, 0)] * nslots
+    records = bytearray()
+    base = HEADER.size + SLOT.size * nslots
+    for name, numbers in resolved.items():
+        key = name.encode("utf-8")
+        h = namehash(key)
+        i = h & (nslots - 1)
+        while slots[i][1]:
+            i = (i + 1) & (nslots - 1)
+        slots[i] = (h, base + len(records))
+        records += struct.pack("<H", len(key)) + key + struct.pack("<I", len(numbers))
+        for number in numbers:
+            records += struct.pack("<B", len(number)) + number.encode("ascii")
+    tmp = index + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, nslots, len(resolved)))
+        for h, offset in slots:
+            f.write(SLOT.pack(h, offset))
+        f.write(records)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, index)
+    return len(resolved)
+
+class DirectoryIndex():
+    """A compiled index, memory mapped"""
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.nslots, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a version {} directory index".format(path, VERSION))
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, name):
+        """The numbers for name, None if it is not in the directory"""
+        key = name.lower().encode("utf-8")
+        h = namehash(key)
+        mask = self.nslots - 1
+        i = h & mask
+        while True:
+            slothash, offset = SLOT.unpack_from(self.map, HEADER.size + SLOT.size * i)
+            if not offset:
+                return None
+            if slothash == h:
+                keylength, = struct.unpack_from("<H", self.map, offset)
+                offset += 2
+                if self.map[offset:offset + keylength] == key:
+                    offset += keylength
+                    count, = struct.unpack_from("<I", self.map, offset)
+                    offset += 4
+                    numbers = []
+                    for n in range(count):
+                        length = self.map[offset]
+                        numbers.append(self.map[offset + 1:offset + 1 + length].decode("ascii"))
+                        offset += 1 + length
+                    return numbers
+            i = (i + 1) & mask
+
+class Directory():
+    """Name and group addressing from a source file, recompiled into the
+    index when the source changes
+
+    A lookup reads whichever index was current when it started. A new
+    index is compiled to a temporary file and renamed into place, and
+    then replaces the mapped one in a single assignment.
+    """
+    def __init__(self, directoryconf):
+        self.source = directoryconf["source"]
+        self.indexpath = directoryconf.get("index", self.source + ".idx")
+        self.interval = float(directoryconf.get("interval", 5))
+        self.logger = logging.getLogger("directory")
+        self.index = None
+        self.mtime = None
+
+    def stale(self):
+        try:
+            mtime = os.stat(self.source).st_mtime_ns
+        except OSError as e:
+            self.logger.error("{}".format(e))
+            return False
+        return mtime != self.mtime
+
+    def refresh(self):
+        """Recompile if the source changed since the index was made, blocking"""
+        mtime = os.stat(self.source).st_mtime_ns
+        if mtime == self.mtime:
+            return False
+        try:
+            indexmtime = os.stat(self.indexpath).st_mtime_ns
+        except OSError:
+            indexmtime = None
+        # an index newer than the source is still good after a restart
+        if indexmtime is None or indexmtime < mtime or self.mtime is not None:
+            count = build(self.source, self.indexpath, self.logger)
+            self.logger.info("Compiled {} entries from {}".format(count, self.source))
+        self.index = DirectoryIndex(self.indexpath)
+        self.mtime = mtime
+        return True
+
+    def loaded(self):
+        return self.index is not None
+
+    def lookup(self, name):
+        index = self.index
+        return index.lookup(name) if index is not None else None
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+import bisect
+import time
+
+# Updating a metric is an increment or two on preallocated numbers,
+# everything else waits until the metrics are rendered.
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def labelstring(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted(labels.items())) + "}"
+
+class Counter():
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self):
+        yield "# HELP {} {}".format(self.name, self.help)
+        yield "# TYPE {} counter".format(self.name)
+        yield "{} {}".format(self.name, self.value)
+
+class Histogram():
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+    def render(self):
+        yield "# HELP {} {}".format(self.name, self.help)
+        yield "# TYPE {} histogram".format(self.name)
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield '{}_bucket{{le="{}"}} {}'.format(self.name, bound, cumulative)
+        cumulative += self.counts[-1]
+        yield '{}_bucket{{le="+Inf"}} {}'.format(self.name, cumulative)
+        yield "{}_sum {}".format(self.name, self.sum)
+        yield "{}_count {}".format(self.name, cumulative)
+
+class Timer():
+    """with histogram.time(): ... observes the elapsed wall clock time"""
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+class Gauge():
+    """Sampled from a callback returning a value or a list of (labels, value)"""
+    def __init__(self, name, help, callback, type="gauge"):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.type = type
+
+    def render(self):
+        yield "# HELP {} {}".format(self.name, self.help)
+        yield "# TYPE {} {}".format(self.name, self.type)
+        value = self.callback()
+        if isinstance(value, list):
+            for labels, v in value:
+                yield "{}{} {}".format(self.name, labelstring(labels), v)
+        else:
+            yield "{} {}".format(self.name, value)
+
+class Registry():
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        # registering again replaces, so objects can be recreated
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self.metrics.get(name) or self.add(Counter(name, help))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self.metrics.get(name) or self.add(Histogram(name, help, buckets))
+
+    def gauge(self, name, help, callback, type="gauge"):
+        return self.add(Gauge(name, help, callback, type))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+parse_seconds = registry.histogram("lmtpsmsd_parse_seconds", "MIME parsing of an incoming message")
+encode_seconds = registry.histogram("lmtpsmsd_encode_seconds", "PDU encoding of a message for all its recipients")
+submit_seconds = registry.histogram("lmtpsmsd_submit_seconds", "AT+CMGS round trip per part")
+connect_seconds = registry.histogram("lmtpsmsd_connect_seconds", "Modem (re)connection")
+messages = registry.counter("lmtpsmsd_messages_total", "Recipients accepted over LMTP")
+parts = registry.counter("lmtpsmsd_parts_total", "SMS parts accepted by a modem")
+tempfails = registry.counter("lmtpsmsd_tempfail_total", "4xx replies given over LMTP")
+rejects = registry.counter("lmtpsmsd_reject_total", "5xx replies given over LMTP")
+suppressed = registry.counter("lmtpsmsd_suppressed_total", "Recipients held back by storm control")
+deferred = registry.counter("lmtpsmsd_deferred_total", "Recipients spooled for later by storm control rate limits")
+expired = registry.counter("lmtpsmsd_expired_total", "Messages dropped past their deadline")
+summaries = registry.counter("lmtpsmsd_summaries_total", "Summaries sent for messages held back")
+reconnects = registry.counter("lmtpsmsd_reconnects_total", "Modem connections made")
+timeouts = registry.counter("lmtpsmsd_command_timeouts_total", "AT commands without a response by their deadline")
+sendfailures = registry.counter("lmtpsmsd_send_failures_total", "Failed modem sessions")
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+import binascii
+import codecs
+import email.policy
+from email.parser import BytesHeaderParser
+
+# states
+HEADERS, SKIP, PARTHEADERS, BODY, DONE = range(5)
+
+headerparser = BytesHeaderParser(policy=email.policy.default)
+
+class MIMEExtractor():
+    """Incremental extraction of the headers and first text/plain part
+
+    Fed one line at a time, without line endings and after dot
+    unstuffing. Only the top level headers, the headers of the parts
+    leading up to the first text/plain part and at most maxchars
+    characters of its decoded body are kept, everything else is only
+    scanned for boundaries, so memory stays flat whatever the size of
+    the attachments.
+    """
+    def __init__(self, maxchars, maxheaderbytes=65536):
+        self.maxchars = maxchars
+        # worst case UTF-8 is four bytes per character
+        self.maxbytes = 4 * maxchars
+        self.maxheaderbytes = maxheaderbytes
+        self.state = HEADERS
+        self.headerlines = []
+        self.headerbytes = 0
+        self.headers = None
+        self.boundaries = []
+        self.body = bytearray()
+        self.base64 = bytearray()
+        self.encoding = "7bit"
+        self.charset = "utf-8"
+
+    def parseheaders(self):
+        headers = headerparser.parsebytes(b"\n".join(self.headerlines) + b"\n\n")
+        self.headerlines = []
+        self.headerbytes = 0
+        return headers
+
+    def startpart(self, headers):
+        """Where to go from the blank line after the headers of a part"""
+        contenttype = headers.get_content_type()
+        if headers.get_content_maintype() == "multipart":
+            boundary = headers.get_param("boundary")
+            if boundary:
+                self.boundaries.append(b"--" + str(boundary).encode("ascii", errors="replace"))
+                return SKIP
+        if contenttype == "text/plain" and headers.get_content_disposition() != "attachment":
+            self.encoding = str(headers.get("Content-Transfer-Encoding", "7bit")).strip().lower()
+            self.charset = str(headers.get_param("charset", "utf-8"))
+            return BODY
+        return SKIP if self.boundaries else DONE
+
+    def boundary(self, line):
+        """Handles a line that may be a multipart boundary, True if it was one"""
+        if not self.boundaries or not line.startswith(b"--"):
+            return False
+        line = line.rstrip()
+        for depth in range(len(self.boundaries) - 1, -1, -1):
+            boundary = self.boundaries[depth]
+            if line == boundary:
+                del self.boundaries[depth + 1:]
+                self.state = PARTHEADERS if self.state != BODY else DONE
+                return True
+            if line == boundary + b"--":
+                del self.boundaries[depth:]
+                self.state = (SKIP if self.boundaries else DONE) if self.state != BODY else DONE
+                return True
+        return False
+
+    def feed(self, line):
+        state = self.state
+        if state == DONE:
+            return
+        if state == HEADERS or state == PARTHEADERS:
+            if line:
+                if self.headerbytes < self.maxheaderbytes:
+                    self.headerlines.append(line)
+                    self.headerbytes += len(line)
+                return
+            headers = self.parseheaders()
+            if state == HEADERS:
+                self.headers = headers
+            self.state = self.startpart(headers)
+            return
+        if self.boundary(line):
+            return
+        if state == BODY:
+            self.decode(line)
+            if len(self.body) >= self.maxbytes:
+                self.state = DONE
+
+    def decode(self, line):
+        if self.encoding == "quoted-printable":
+            if line.endswith(b"="):
+                self.body += binascii.a2b_qp(line[:-1])
+            else:
+                self.body += binascii.a2b_qp(line) + b"\n"
+        elif self.encoding == "base64":
+            self.base64 += line.strip()
+            usable = len(self.base64) - len(self.base64) % 4
+            try:
+                self.body += binascii.a2b_base64(bytes(self.base64[:usable]))
+            except binascii.Error:
+                pass
+            del self.base64[:usable]
+        else:
+            self.body += line + b"\n"
+
+    def close(self):
+        if self.headers is None:
+            # no blank line after the headers
+            self.headers = self.parseheaders()
+        return self
+
+    def text(self):
+        """The decoded body of the first text/plain part, at most maxchars long"""
+        try:
+            codecs.lookup(self.charset)
+        except LookupError:
+            self.charset = "utf-8"
+        return self.body.decode(self.charset, errors="replace")[:self.maxchars].rstrip()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+class ModemState():
+    """What is known about the modem's settings, None when unknown
+
+    Kept by SMSDevice across reconnects. Commands whose effect is
+    already in place are skipped. Everything is forgotten when there
+    are signs of a reset: the modem does not answer on reconnect,
+    reports an equipment error, asks for the PIN again, goes away with
+    an I/O error or fails twice in a row.
+    """
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        self.pdumode = None
+        self.speed = None
+        self.pinready = None
+        self.errorreporting = None
+        # the registration reports turned on, ("+CREG", "+CEREG") or fewer
+        self.networkreports = None
+
+    def known(self):
+        return self.pinready is not None
+
+# +CREG/+CEREG <stat>: registered, home network or roaming
+REGISTERED = ("1", "5")
+
+class NotRegistered(Exception):
+    """The modem answers but has no network to send through"""
+
+class MessageRejected(Exception):
+    """The modem took the PDU, but the SMSC or the modem refused this
+    message with a +CMS ERROR"""
+
+class NetworkState():
+    """Registration and signal quality as last reported by the modem
+
+    Kept by SMSDevice across reconnects, updated on the serial thread
+    from unsolicited +CREG/+CEREG reports and from the answers to
+    AT+CREG?, AT+CEREG? and AT+CSQ.
+    """
+    def __init__(self):
+        # <stat> per report, +CREG for GSM and +CEREG for LTE
+        self.registration = {}
+        self.rssi = None
+
+    def update(self, line):
+        """True if line was a registration or signal report"""
+        report, colon, fields = line.partition(":")
+        fields = [field.strip() for field in fields.split(",")]
+        if report in ("+CREG", "+CEREG"):
+            # AT+CREG? answers <n>,<stat>, the reports with AT+CREG=1 are <stat>
+            self.registration[report] = fields[1] if len(fields) > 1 else fields[0]
+            return True
+        if report == "+CSQ":
+            self.rssi = int(fields[0])
+            return True
+        return False
+
+    def lost(self):
+        """The modem refused to send for lack of network"""
+        for report in self.registration or ("+CREG",):
+            self.registration[report] = "0"
+
+    def registered(self):
+        """None until the modem has said, then whether any network has it"""
+        if not self.registration:
+            return None
+        return any(stat in REGISTERED for stat in self.registration.values())
+
+    def dbm(self):
+        """Signal strength from the AT+CSQ <rssi>, None if unknown"""
+        if self.rssi is None or self.rssi == 99:
+            return None
+        return -113 + 2 * self.rssi
+
+    def describe(self):
+        registered = self.registered()
+        if registered is None:
+            return ""
+        description = "registered" if registered else "not registered"
+        if self.dbm() is not None:
+            description += ", {} dBm".format(self.dbm())
+        return description
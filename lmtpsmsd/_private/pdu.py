@@ -24,131 +24,305 @@
 
 from __future__ import print_function, unicode_literals
 
+import random
 import smsutil
 
-class OctetArray:
-    def __init__(self, octets):
-        self.values = octets
-
-    def hex(self):
-        return "".join(["{:02X}".format(octet) for octet in self.values])
-
-    def __len__(self):
-        return len(self.values)
-
-class NibbleArray:
-    def __init__(self, nibbles):
-        self.values = nibbles
-
-    def hex(self):
-        def split_pairs(values):
-            if len(values) == 0:
-                return ""
-            if len(values) == 1:
-                return "F{:01X}".format(values[0])
-            if len(values) == 2:
-                return "{:01X}{:01X}".format(values[1], values[0])
-            return "{}{}".format(split_pairs(values[0:2]), split_pairs(values[2:]))
-        return split_pairs(self.values)
-
-    def __len__(self):
-        return len(self.values)
-
-    def octet_length(self):
-        l = len(self)
-        if l % 2 == 1:
-            return (l+1)/2
-        return l/2
-
-class BitArray:
-    def __init__(self, bits):
-        self.values = [bool(bit) for bit in bits]
-
-    def little_endian_octets(self):
-        def octetvalues(bits):
-            for i in range(0, len(bits), 8):
-                eightbits = reversed(bits[i:(i+8)])
-                binarystring = "".join(["1" if bit else "0" for bit in eightbits])
-                yield int(binarystring, 2)
-        return OctetArray(octetvalues(self.values))
-
-class SeptetArray:
-    def __init__(self, septets):
-        self.values = septets
-
-    def __len__(self):
-        return len(self.values)
-
-    def little_endian_bits(self):
-        def bits(septets):
-            for septet in septets:
-                for bit in reversed("{:07b}".format(septet)):
-                    yield (True if bit == "1" else False)
-        return BitArray(bits(self.values))
+from .lrucache import LRUCache
+
+# Alerts go to the same few numbers and reuse the same texts, so encoded
+# destinations and split, encoded and packed bodies are kept around.
+destinations = LRUCache(1024, 64 * 1024)
+bodies = LRUCache(1024, 1024 * 1024)
+
+def configure_caches(cacheconf):
+    destinations.configure(int(cacheconf.get("destinations", 1024)), int(cacheconf.get("destinationbytes", 64 * 1024)))
+    bodies.configure(int(cacheconf.get("bodies", 1024)), int(cacheconf.get("bodybytes", 1024 * 1024)))
+
+# Nibble swapped value of every octet, for semi-octet encoding
+SWAPPED_NIBBLES = bytes(((octet & 0x0F) << 4) | (octet >> 4) for octet in range(256))
+
+def semi_octets(digits):
+    """Digits as swapped semi-octets, padded with F"""
+    if not (digits.isascii() and digits.isdigit()):
+        raise ValueError("not a phone number: {}".format(digits))
+    if len(digits) % 2 == 1:
+        digits += "F"
+    return bytes.fromhex(digits).translate(SWAPPED_NIBBLES)
+
+def packed_septets_length(count, fillbits=0):
+    return (fillbits + 7 * count + 7) // 8
+
+def pack_septets_into(buf, offset, septets, fillbits=0):
+    """Pack septets little endian into buf from offset, returns the end offset"""
+    acc = 0
+    nbits = fillbits
+    for septet in septets:
+        acc |= septet << nbits
+        nbits += 7
+        if nbits >= 8:
+            buf[offset] = acc & 0xFF
+            offset += 1
+            acc >>= 8
+            nbits -= 8
+    if nbits > 0:
+        buf[offset] = acc & 0xFF
+        offset += 1
+    return offset
 
 class NullPhoneNumber:
+    def smsc_octets(self):
+        return b'\x00'
+
     def smsc_hexrepr(self):
-        return "00"
+        return self.smsc_octets().hex().upper()
 
 class PhoneNumber:
     def __init__(self, number):
         self.number = number
-        self.nibbles = NibbleArray([int(digit) for digit in number if digit != "+"])
+        self.digits = number.replace("+", "")
+        self.octets = None
 
     def __str__(self):
         return self.number
 
+    def dest_octets(self):
+        if self.octets is None:
+            self.octets = destinations.get(self.number)
+        if self.octets is None:
+            numtype = 0x91 if self.number.startswith("+") else 0x81
+            self.octets = bytes((len(self.digits), numtype)) + semi_octets(self.digits)
+            destinations.put(self.number, self.octets)
+        return self.octets
+
     def dest_hexrepr(self):
-        numtype = 0x91 if self.number.startswith("+") else 0x81
-        length = len(self.nibbles)
-        number_hex = self.nibbles.hex()
-        return "{:02X}{:02X}{}".format(length, numtype, number_hex)
+        return self.dest_octets().hex().upper()
+
+class ConcatenationHeader:
+    """User data header with the 8 bit reference concatenation element"""
+    def __init__(self, reference, total, sequence):
+        self.octets = bytes((0x05, 0x00, 0x03, reference, total, sequence))
+
+    def __len__(self):
+        return len(self.octets)
+
+    def hex(self):
+        return self.octets.hex().upper()
+
+class ConcatenationReferences:
+    """Reference numbers for concatenated messages, counted per destination
+    for the destinations used most recently"""
+    def __init__(self, maxentries=1024):
+        self.references = LRUCache(maxentries, maxentries * 64, sizeof=lambda item: len(str(item)))
+
+    def next(self, destination):
+        key = str(destination)
+        # start anywhere so a restart or eviction doesn't reuse recent references
+        reference = self.references.get(key)
+        if reference is None:
+            reference = random.randrange(256)
+        self.references.put(key, (reference + 1) % 256)
+        return reference
+
+references = ConcatenationReferences()
+
+class EncodedText:
+    """A message split into parts, each as septets and packed octets, or
+    for UCS-2 as octets only"""
+    def __init__(self, message):
+        sms_split = smsutil.split(message)
+
+        self.ucs2 = sms_split.encoding != 'gsm0338'
+        self.parts = []
+        if self.ucs2:
+            for part in sms_split.parts:
+                self.parts.append((part.content.encode("utf_16_be"), b''))
+            return
+        # concatenated parts follow a 6 octet header and 1 fill bit
+        fillbits = 1 if len(sms_split.parts) > 1 else 0
+        for part in sms_split.parts:
+            septets = smsutil.encode(part.content)
+            packed = bytearray(packed_septets_length(len(septets), fillbits))
+            pack_septets_into(packed, 0, septets, fillbits)
+            self.parts.append((septets, bytes(packed)))
+
+    def __len__(self):
+        return sum(len(septets) + len(packed) for septets, packed in self.parts)
 
 class GSM0338Body:
-    def __init__(self, gsm0338bytes):
-        self.content = SeptetArray(gsm0338bytes)
+    def __init__(self, gsm0338bytes, header=None, packed=None):
+        self.content = gsm0338bytes
+        self.header = header
+        self.packed = packed
+
+    def header_septets(self):
+        if self.header is None:
+            return 0
+        # the header is padded with fill bits up to a septet boundary
+        return (len(self.header) * 8 + 6) // 7
+
+    def fillbits(self):
+        return self.header_septets() * 7 - len(self.header) * 8 if self.header is not None else 0
 
     def __len__(self):
-        return len(self.content)
+        return self.header_septets() + len(self.content)
+
+    def octet_length(self):
+        headerlength = len(self.header) if self.header is not None else 0
+        return headerlength + packed_septets_length(len(self.content), self.fillbits())
+
+    def pack_into(self, buf, offset):
+        if self.header is not None:
+            end = offset + len(self.header)
+            buf[offset:end] = self.header.octets
+            offset = end
+        if self.packed is not None:
+            end = offset + len(self.packed)
+            buf[offset:end] = self.packed
+            return end
+        return pack_septets_into(buf, offset, self.content, self.fillbits())
+
+    def octets(self):
+        buf = bytearray(self.octet_length())
+        self.pack_into(buf, 0)
+        return bytes(buf)
 
     def hex(self):
-        return self.content.little_endian_bits().little_endian_octets().hex()
+        return self.octets().hex().upper()
 
     def codingscheme(self):
         return 0x00
 
+    def with_header(self, header):
+        return GSM0338Body(self.content, header, self.packed)
+
+class UCS2Body:
+    """UCS-2 user data, where TP-UDL counts octets and no fill bits are needed"""
+    def __init__(self, ucs2bytes, header=None):
+        self.content = ucs2bytes
+        self.header = header
+
+    def __len__(self):
+        return self.octet_length()
+
+    def octet_length(self):
+        return (len(self.header) if self.header is not None else 0) + len(self.content)
+
+    def pack_into(self, buf, offset):
+        if self.header is not None:
+            end = offset + len(self.header)
+            buf[offset:end] = self.header.octets
+            offset = end
+        end = offset + len(self.content)
+        buf[offset:end] = self.content
+        return end
+
+    def octets(self):
+        buf = bytearray(self.octet_length())
+        self.pack_into(buf, 0)
+        return bytes(buf)
+
+    def hex(self):
+        return self.octets().hex().upper()
+
+    def codingscheme(self):
+        return 0x08
+
+    def with_header(self, header):
+        return UCS2Body(self.content, header)
+
 class SMSC_and_TPDU:
     def __init__(self, destination, messagebody, smsc=NullPhoneNumber()):
         self.smsc = smsc
         self.destination = destination
         self.messagebody = messagebody
+        self.encoded = None
+
+    def firstoctet(self):
+        # SMS-SUBMIT, with TP-UDHI set when there is a user data header
+        return 0x01 if getattr(self.messagebody, "header", None) is None else 0x41
+
+    def tpdu(self):
+        """The TPDU octets, encoded once into a single buffer"""
+        if self.encoded is None:
+            dest = self.destination.dest_octets()
+            body = self.messagebody
+            udoffset = 5 + len(dest)
+            buf = bytearray(udoffset + body.octet_length())
+            view = memoryview(buf)
+            buf[0] = self.firstoctet()
+            # buf[1] TP-MR is 0
+            view[2:2 + len(dest)] = dest
+            # buf[udoffset - 3] TP-PID is 0
+            buf[udoffset - 2] = body.codingscheme()
+            buf[udoffset - 1] = len(body)
+            body.pack_into(view, udoffset)
+            self.encoded = bytes(buf)
+        return self.encoded
+
+    def readdressed(self, destination, header=None):
+        """The same message to another destination, patching the encoded TPDU"""
+        tpdu = self.tpdu()
+        old = 2 + len(self.destination.dest_octets())
+        dest = destination.dest_octets()
+        new = 2 + len(dest)
+        buf = bytearray(len(tpdu) - old + new)
+        view = memoryview(buf)
+        view[0:2] = tpdu[0:2]
+        view[2:new] = dest
+        view[new:] = tpdu[old:]
+        body = self.messagebody
+        if header is not None:
+            # TP-PID, TP-DCS and TP-UDL come before the user data header
+            view[new + 3:new + 3 + len(header)] = header.octets
+            body = body.with_header(header)
+        readdressed = SMSC_and_TPDU(destination, body, self.smsc)
+        readdressed.encoded = bytes(buf)
+        return readdressed
 
     def hex(self):
-        return "{}{}".format(self.smsc_hex(), self.tpdu_hex())
+        return (self.smsc.smsc_octets() + self.tpdu()).hex().upper()
 
     def smsc_hex(self):
         return self.smsc.smsc_hexrepr()
 
     def tpdu_hex(self):
-        return "0100{}00{:02x}{:02x}{}".format(self.destination.dest_hexrepr(), self.messagebody.codingscheme(), len(self.messagebody), self.messagebody.hex())
+        return self.tpdu().hex().upper()
 
     def tpdu_octet_length(self):
-        return int(len(self.tpdu_hex()) / 2)
+        return len(self.tpdu())
 
 class TextMessage:
-    def __init__(self, destination, message):
+    def __init__(self, destination, message, references=references):
         self.destination = PhoneNumber(str(destination))
+        # a bad number raises ValueError here rather than when first sent
+        self.destination.dest_octets()
         self.message = message
-
-    def parts(self):
-        sms_split = smsutil.split(self.message)
-
-        # TODO allow other encodings
-        if sms_split.encoding == 'gsm0338':
-            for part in sms_split.parts:
-                gsm0338 = smsutil.encode(part.content)
-                body = GSM0338Body(gsm0338)
-                yield SMSC_and_TPDU(self.destination, body)
-        else:
-            raise NotImplementedError("non gsm0338 encoded messages")
-
+        self.references = references
+
+    def encoded(self):
+        encoded = bodies.get(self.message)
+        if encoded is None:
+            encoded = EncodedText(self.message)
+            bodies.put(self.message, encoded)
+        return encoded
+
+    def parts(self, template=None):
+        """The PDUs, or when given the parts of the same text to another
+        destination only the address and concatenation reference are patched"""
+        if template is not None:
+            total = len(template)
+            reference = self.references.next(self.destination) if total > 1 else None
+            for sequence, part in enumerate(template, start=1):
+                header = ConcatenationHeader(reference, total, sequence) if total > 1 else None
+                yield part.readdressed(self.destination, header)
+            return
+        encoded = self.encoded()
+        total = len(encoded.parts)
+        reference = self.references.next(self.destination) if total > 1 else None
+        for sequence, (content, packed) in enumerate(encoded.parts, start=1):
+            header = ConcatenationHeader(reference, total, sequence) if total > 1 else None
+            if encoded.ucs2:
+                body = UCS2Body(content, header)
+            else:
+                body = GSM0338Body(content, header, packed)
+            yield SMSC_and_TPDU(self.destination, body)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+import time
+import asyncio
+import collections
+
+# priority classes, most urgent first
+URGENT, HIGH, NORMAL, BULK = range(4)
+CLASSES = {"urgent": URGENT, "high": HIGH, "normal": NORMAL, "bulk": BULK}
+
+X_PRIORITY = {"1": URGENT, "2": HIGH, "3": NORMAL, "4": BULK, "5": BULK}
+IMPORTANCE = {"high": HIGH, "normal": NORMAL, "low": BULK}
+PRIORITY = {"emergency": URGENT, "urgent": URGENT, "normal": NORMAL, "non-urgent": BULK}
+PRECEDENCE = {"bulk": BULK, "list": BULK, "junk": BULK}
+
+def header_priority(msg):
+    """Priority class from the X-Priority, Priority, Importance or Precedence header"""
+    value = str(msg.get("X-Priority", "")).strip()[:1]
+    if value in X_PRIORITY:
+        return X_PRIORITY[value]
+    for header, classes in (("Priority", PRIORITY), ("Importance", IMPORTANCE), ("Precedence", PRECEDENCE)):
+        value = str(msg.get(header, "")).strip().lower()
+        if value in classes:
+            return classes[value]
+    return None
+
+def header_deadline(msg):
+    """Wall clock time from the Expires or Expiry-Date header"""
+    value = msg.get("Expires") or msg.get("Expiry-Date")
+    if value is None:
+        return None
+    import email.utils
+    try:
+        return email.utils.parsedate_to_datetime(str(value)).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def split_extension(localpart):
+    """number+class, a leading + is part of the number"""
+    number, delimiter, extension = localpart[1:].partition("+")
+    return localpart[:1] + number, extension.lower() or None
+
+class Scheduler():
+    """Queue of spool entries by priority class, round robin across
+    recipients within a class
+
+    Within a class each number has a FIFO of its own, and numbers take
+    turns, so one bulk notification to many people does not hold up
+    the next message to someone else in the same class, and nothing in
+    a lower class goes out while a higher class has entries waiting.
+    """
+    def __init__(self, priorityconf=None):
+        self.configure(priorityconf)
+        self.classes = [collections.OrderedDict() for priority in CLASSES]
+        self.size = 0
+        self.nonempty = asyncio.Event()
+
+    def configure(self, priorityconf=None):
+        """Applies to messages accepted from now on, queued ones keep their deadlines"""
+        priorityconf = priorityconf or {}
+        # seconds after acceptance when a message is no longer worth sending, 0 for never
+        self.maxage = {priority: float(priorityconf.get(name, 0)) for name, priority in CLASSES.items()}
+        self.default = CLASSES[priorityconf.get("default", "normal")]
+
+    def deadline(self, priority, accepted=None):
+        maxage = self.maxage[priority]
+        if not maxage:
+            return None
+        return (time.time() if accepted is None else accepted) + maxage
+
+    def qsize(self):
+        return self.size
+
+    def sizes(self):
+        return {name: sum(len(fifo) for fifo in self.classes[priority].values()) for name, priority in CLASSES.items()}
+
+    def empty(self):
+        return self.size == 0
+
+    def nextpriority(self):
+        """Class of the entry get_nowait() would return, None if empty"""
+        for priority, numbers in enumerate(self.classes):
+            if numbers:
+                return priority
+        return None
+
+    def put_nowait(self, entry):
+        numbers = self.classes[entry.priority]
+        fifo = numbers.get(entry.number)
+        if fifo is None:
+            fifo = numbers[entry.number] = collections.deque()
+        fifo.append(entry)
+        self.size += 1
+        self.nonempty.set()
+
+    def putback(self, entries):
+        """Entries taken out but not sent, back at the head of the line
+        in the same order"""
+        for entry in reversed(entries):
+            numbers = self.classes[entry.priority]
+            fifo = numbers.get(entry.number)
+            if fifo is None:
+                fifo = numbers[entry.number] = collections.deque()
+            fifo.appendleft(entry)
+            numbers.move_to_end(entry.number, last=False)
+            self.size += 1
+        if entries:
+            self.nonempty.set()
+
+    def get_nowait(self):
+        for numbers in self.classes:
+            if numbers:
+                number, fifo = next(iter(numbers.items()))
+                entry = fifo.popleft()
+                # this number goes to the back of the line
+                del numbers[number]
+                if fifo:
+                    numbers[number] = fifo
+                self.size -= 1
+                return entry
+        raise asyncio.QueueEmpty()
+
+    async def get(self):
+        while self.empty():
+            self.nonempty.clear()
+            await self.nonempty.wait()
+        return self.get_nowait()
@@ -42,29 +42,278 @@
 # 8. By copying, installing or otherwise using Python 3.8.2, Licensee agrees
 #    to be bound by the terms and conditions of this License Agreement.
 
+
 from __future__ import print_function, unicode_literals
 
-import asyncore
-import lmtpd
+import asyncio
+import logging
+import socket
+
+__version__ = 'lmtpsmsd LMTP server'
+
+# longest command or message line accepted
+MAX_LINE = 65536
+
+class LMTPChannel():
+    """One LMTP session, modelled on lmtpd.LMTPChannel
+
+    Replies are held back while more pipelined input is already at
+    hand, and go out together once the input runs dry.
+    """
+    def __init__(self, server, reader, writer, listener=None):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.listener = listener
+        self.logger = logging.getLogger("lmtp")
+        self.greeting = None
+        self.mailfrom = None
+        self.rcpttos = []
+        self.closing = False
+        self.peer = writer.get_extra_info("peername")
+        self.buffer = bytearray()
+        self.replies = []
+
+    def push(self, msg):
+        self.replies.append(msg + b'\r\n')
 
-class LMTPSocketServer(lmtpd.LMTPServer):
-    """Like LMTPServer but initialized with a socket"""
-    def __init__(self, sock):
-        self._fileno = None
+    async def flush(self):
+        if self.replies:
+            self.writer.write(b''.join(self.replies))
+            self.replies = []
+        await self.writer.drain()
 
-        asyncore.dispatcher.__init__(self)
+    async def readline(self):
+        end = self.buffer.find(b'\r\n')
+        while end < 0:
+            if len(self.buffer) > MAX_LINE:
+                raise asyncio.LimitOverrunError("line too long", len(self.buffer))
+            # nothing more to go on until the client sends more
+            await self.flush()
+            data = await self.reader.read(MAX_LINE)
+            if not data:
+                raise asyncio.IncompleteReadError(bytes(self.buffer), None)
+            start = max(0, len(self.buffer) - 1)
+            self.buffer += data
+            end = self.buffer.find(b'\r\n', start)
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end + 2]
+        return line
 
+    async def run(self):
         try:
-            sock.setblocking(0)
-            self.set_socket(sock)
-            self.connected = True
-            self.listen(5)
-        except:
-            self.close()
-            raise
+            self.push(b' '.join([b'220', self.server.fqdn.encode(), __version__.encode()]))
+            while not self.closing:
+                try:
+                    line = await self.readline()
+                except asyncio.IncompleteReadError:
+                    break
+                await self.found_command(line)
+            await self.flush()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+            self.logger.warning("LMTP session aborted: {}".format(e))
+        finally:
+            self.writer.close()
+
+    async def found_command(self, line):
+        if not line:
+            self.push(b'500 5.5.2 Error: bad syntax')
+            return
+        i = line.find(b' ')
+        if i < 0:
+            command = line.upper()
+            arg = None
+        else:
+            command = line[:i].upper()
+            arg = line[i+1:].strip()
+        method = getattr(self, 'lmtp_' + command.decode("ascii", errors='replace'), None)
+        if not method:
+            self.push(b''.join([b'502 5.5.2 Error: command "', command, b'" not implemented']))
+            return
+        await method(arg)
+
+    async def readdata(self):
+        """Streams the message into a server.dataparser(), None if it was
+        larger than server.maxsize"""
+        parser = self.server.dataparser()
+        size = 0
+        maxsize = self.server.maxsize
+        while True:
+            line = await self.readline()
+            if line == b'.':
+                break
+            if line.startswith(b'.'):
+                line = line[1:]
+            size += len(line) + 2
+            if maxsize and size > maxsize:
+                # read to the end, but keep nothing
+                parser = None
+                continue
+            parser.feed(line)
+        return parser.close() if parser is not None else None
+
+    # LMTP commands
+    async def lmtp_LHLO(self, arg):
+        if not arg:
+            self.push(b'501 5.5.4 Syntax: LHLO hostname')
+        elif self.greeting:
+            self.push(b'503 5.5.1 Duplicate LHLO')
+        else:
+            self.greeting = arg
+            self.push(b'250-' + self.server.fqdn.encode())
+            self.push(b'250-ENHANCEDSTATUSCODES')
+            self.push('250-SIZE {}'.format(self.server.maxsize).encode())
+            self.push(b'250 PIPELINING')
+
+    async def lmtp_NOOP(self, arg):
+        if arg:
+            self.push(b'501 5.5.4 Syntax: NOOP')
+        else:
+            self.push(b'250 2.0.0 Ok')
+
+    async def lmtp_QUIT(self, arg):
+        self.push(b'221 2.0.0 Bye')
+        self.closing = True
+
+    def getaddr(self, keyword, arg):
+        address = None
+        keylen = len(keyword)
+        if arg[:keylen].upper() == keyword:
+            address = arg[keylen:].strip()
+            if not address:
+                pass
+            elif address[0:1] == b'<' and address[-1:] == b'>' and address != b'<>':
+                address = address[1:-1]
+        return address
 
+    def getparams(self, address):
+        """Splits ESMTP parameters such as SIZE=n off the address"""
+        parts = address.split()
+        params = {}
+        for param in parts[1:]:
+            key, eq, value = param.partition(b'=')
+            params[key.upper()] = value
+        address = parts[0] if parts else address
+        if address[0:1] == b'<' and address[-1:] == b'>' and address != b'<>':
+            address = address[1:-1]
+        return address, params
+
+    async def lmtp_MAIL(self, arg):
+        address = self.getaddr(b'FROM:', arg) if arg else None
+        if not address:
+            self.push(b'501 5.5.4 Syntax: MAIL FROM:<address>')
+            return
+        if self.mailfrom:
+            self.push(b'503 5.5.1 Error: nested MAIL command')
+            return
+        address, params = self.getparams(address)
         try:
-            self.addr = self.socket.getpeername()
-        except OSError as err:
-            self.addr = None
+            size = int(params.get(b'SIZE', 0))
+        except ValueError:
+            self.push(b'501 5.5.4 Syntax: SIZE=<size>')
+            return
+        if self.server.maxsize and size > self.server.maxsize:
+            self.push(b'552 5.3.4 Message size exceeds fixed maximum message size')
+            return
+        self.mailfrom = address
+        self.push(b'250 2.1.0 Ok')
+
+    async def lmtp_RCPT(self, arg):
+        if not self.mailfrom:
+            self.push(b'503 5.5.1 Error: need MAIL command')
+            return
+        address = self.getaddr(b'TO:', arg) if arg else None
+        if not address:
+            self.push(b'501 5.5.4 Syntax: RCPT TO: <address>')
+            return
+        self.rcpttos.append(address)
+        self.push(b'250 2.1.0 Ok')
+
+    async def lmtp_RSET(self, arg):
+        if arg:
+            self.push(b'501 5.5.4 Syntax: RSET')
+            return
+        self.mailfrom = None
+        self.rcpttos = []
+        self.push(b'250 2.0.0 Ok')
+
+    async def lmtp_DATA(self, arg):
+        if not self.rcpttos:
+            self.push(b'503 5.5.1 Error: need RCPT command')
+            return
+        if arg:
+            self.push(b'501 5.5.4 Syntax: DATA')
+            return
+        self.push(b'354 End data with <CR><LF>.<CR><LF>')
+        await self.flush()
+        data = await self.readdata()
+        # LMTP wants one reply per RCPT TO
+        if data is None:
+            statuses = [b'552 5.3.4 Message size exceeds fixed maximum message size'] * len(self.rcpttos)
+        else:
+            try:
+                statuses = await self.server.process_messages(self.peer, self.mailfrom, self.rcpttos, data)
+            except Exception:
+                # a bug should not cost the MTA the session, it tries again
+                self.logger.exception("Processing the message failed")
+                statuses = [b'451 4.3.0 Error: internal error'] * len(self.rcpttos)
+        for status in statuses:
+            if not status:
+                self.push(b'250 2.0.0 Ok')
+            elif isinstance(status, bytes):
+                self.push(status)
+            else:
+                self.push(status.encode("utf-8"))
+        self.mailfrom = None
+        self.rcpttos = []
+
+class DataBuffer():
+    """The whole message, lines joined with newlines"""
+    def __init__(self):
+        self.lines = []
+
+    def feed(self, line):
+        self.lines.append(line)
+
+    def close(self):
+        return b'\n'.join(self.lines)
+
+class LMTPSocketServer():
+    """Like lmtpd.LMTPServer but running on asyncio and initialized with
+    a socket, or a list of (name, socket) to serve them all"""
+    def __init__(self, sock, backlog=socket.SOMAXCONN, maxsize=0):
+        self.socks = list(sock) if isinstance(sock, (list, tuple)) else [("lmtp", sock)]
+        self.backlog = backlog
+        # largest message accepted in bytes, 0 for no limit
+        self.maxsize = maxsize
+        self.fqdn = socket.getfqdn()
+        self.servers = []
+        self.connections = {name: 0 for name, sock in self.socks}
+
+    async def start(self):
+        for name, sock in self.socks:
+            sock.setblocking(False)
+            def handle_connection(reader, writer, name=name):
+                return self.handle_connection(reader, writer, name)
+            # listen() again, so the backlog is ours rather than Backlog= of the socket unit
+            if sock.family == socket.AF_UNIX:
+                server = await asyncio.start_unix_server(handle_connection, sock=sock, backlog=self.backlog)
+            else:
+                server = await asyncio.start_server(handle_connection, sock=sock, backlog=self.backlog)
+            self.servers.append(server)
+
+    async def handle_connection(self, reader, writer, listener=None):
+        self.connections[listener] = self.connections.get(listener, 0) + 1
+        await LMTPChannel(self, reader, writer, listener).run()
+
+    def dataparser(self):
+        """What the message is fed into line by line, override to parse it
+        as it streams in; the result of its close() is passed on as data"""
+        return DataBuffer()
+
+    async def process_messages(self, peer, mailfrom, rcpttos, data):
+        """Returns one status per recipient, override to handle them all at once"""
+        return [await self.process_message(peer, mailfrom, rcptto, data) for rcptto in rcpttos]
 
+    async def process_message(self, peer, mailfrom, rcptto, data):
+        raise NotImplementedError
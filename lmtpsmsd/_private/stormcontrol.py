@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+import re
+import time
+import hashlib
+import collections
+
+WHITESPACE = re.compile(r"\s+")
+DIGITS = re.compile(r"\d+")
+
+class TokenBucket():
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.last = now
+
+    def refill(self, rate, burst, now):
+        self.tokens = min(burst, self.tokens + max(0, now - self.last) * rate)
+        self.last = now
+
+    def take(self, rate):
+        """Seconds until the token taken is earned, tokens may go below zero"""
+        self.tokens -= 1
+        return max(0, -self.tokens / rate) if rate > 0 else 0
+
+class StormEntry():
+    def __init__(self, number, text, now):
+        self.number = number
+        self.text = text
+        self.start = now
+        self.suppressed = 0
+
+    def summary(self):
+        return "({} more similar) {}".format(self.suppressed, self.text)
+
+class StormControl():
+    """Deduplication, coalescing and rate limiting of outgoing messages
+
+    A message to the same number with the same normalized text as one
+    sent within the last window seconds is suppressed. When the window
+    of a message runs out, the suppressed copies turn into a single
+    summary message. Any other message beyond the per destination or
+    global token bucket is not dropped but delayed until the buckets
+    have earned its token, the caller spools it with that delay. The
+    index and the buckets hold at most maxentries each, evicting the
+    oldest, so memory stays bounded.
+    """
+    def __init__(self, stormconf):
+        self.configure(stormconf)
+        self.index = collections.OrderedDict()
+        self.buckets = collections.OrderedDict()
+        self.globalbucket = TokenBucket(self.globalburst, time.monotonic())
+        self.pending = []
+
+    def configure(self, stormconf):
+        """Takes effect with the next message, what is held back stays held"""
+        self.window = float(stormconf.get("window", 300))
+        self.maxentries = int(stormconf.get("maxentries", 10000))
+        self.maxtext = int(stormconf.get("maxtext", 160))
+        self.ignoredigits = str(stormconf.get("ignoredigits", "yes")).lower() in ("yes", "true", "on", "1")
+        self.destrate = float(stormconf.get("destrate", 0.1))
+        self.destburst = float(stormconf.get("destburst", 5))
+        self.globalrate = float(stormconf.get("globalrate", 1))
+        self.globalburst = float(stormconf.get("globalburst", 30))
+
+    def normalize(self, text):
+        text = WHITESPACE.sub(" ", text).strip().casefold()
+        if self.ignoredigits:
+            text = DIGITS.sub("#", text)
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+
+    def bucket(self, number, now):
+        bucket = self.buckets.pop(number, None)
+        if bucket is None:
+            bucket = TokenBucket(self.destburst, now)
+        self.buckets[number] = bucket
+        if len(self.buckets) > self.maxentries:
+            self.buckets.popitem(last=False)
+        return bucket
+
+    def evict(self, now):
+        """Retire expired entries, and the oldest ones beyond maxentries"""
+        while self.index:
+            key, entry = next(iter(self.index.items()))
+            if entry.start + self.window > now and len(self.index) <= self.maxentries:
+                break
+            del self.index[key]
+            if entry.suppressed:
+                self.pending.append(entry)
+
+    def admit(self, number, text, now=None):
+        """None if the message was suppressed as a duplicate, otherwise
+        the seconds it has to wait to keep within the rates"""
+        now = time.monotonic() if now is None else now
+        self.evict(now)
+        key = (number, self.normalize(text))
+        entry = self.index.get(key)
+        if entry is not None:
+            entry.suppressed += 1
+            entry.text = text[:self.maxtext]
+            return None
+        bucket = self.bucket(number, now)
+        bucket.refill(self.destrate, self.destburst, now)
+        self.globalbucket.refill(self.globalrate, self.globalburst, now)
+        delay = max(bucket.take(self.destrate), self.globalbucket.take(self.globalrate))
+        self.index[key] = StormEntry(number, text[:self.maxtext], now)
+        self.evict(now)
+        return delay
+
+    def summaries(self, now=None):
+        """(number, text) of the summary messages due by now"""
+        now = time.monotonic() if now is None else now
+        self.evict(now)
+        pending, self.pending = self.pending, []
+        for entry in pending:
+            yield entry.number, entry.summary()
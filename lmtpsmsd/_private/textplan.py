@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+import re
+import unicodedata
+import smsutil
+
+# septets, or octets for UCS-2, in a single and in a concatenated part
+GSM_SINGLE, GSM_MULTI = 160, 153
+UCS2_SINGLE, UCS2_MULTI = 140, 134
+
+HORIZONTAL_SPACE = re.compile(r"[^\S\n]+")
+LINE_BREAKS = re.compile(r" ?\n[\s]*")
+# RFC 3676 signature separator, and everything after it
+SIGNATURE = re.compile(r"\n-- ?\n.*", re.DOTALL)
+
+# look-alikes outside GSM 03.38, most of them typographic
+TRANSLITERATIONS = {
+    "‘": "'", "’": "'", "‚": "'", "‛": "'", "′": "'", "´": "'", "`": "'",
+    "“": '"', "”": '"', "„": '"', "‟": '"', "″": '"', "«": '"', "»": '"',
+    "‐": "-", "‑": "-", "‒": "-", "–": "-", "—": "-", "―": "-", "−": "-",
+    "…": "...", "•": "*", "·": ".", "×": "x", "⁄": "/",
+    " ": " ", " ": " ", " ": " ", " ": " ", " ": " ",
+    "™": "TM", "©": "(C)", "®": "(R)", "°": "o", "½": "1/2",
+    "←": "<-", "→": "->", "≤": "<=", "≥": ">=", "≠": "!=",
+    "ı": "i", "œ": "oe", "Œ": "OE", "ł": "l", "Ł": "L", "đ": "d", "Đ": "D",
+}
+
+def is_gsm(char):
+    return smsutil.is_valid_gsm(char)
+
+def gsm_cost(char):
+    return 2 if char in smsutil.GSM_EXT_CHARSET else 1
+
+def ucs2_cost(char):
+    return 4 if ord(char) > 0xFFFF else 2
+
+def transliterate_char(char):
+    """GSM 03.38 text for char, "" for symbols without one, None for
+    letters of other scripts"""
+    if is_gsm(char):
+        return char
+    if char in TRANSLITERATIONS:
+        return TRANSLITERATIONS[char]
+    # accented letters without a GSM 03.38 code point lose the accent
+    base = "".join(c for c in unicodedata.normalize("NFKD", char) if not unicodedata.combining(c))
+    if base and all(is_gsm(c) for c in base):
+        return base
+    # emoji, variation selectors, joiners and the like
+    if unicodedata.category(char) in ("So", "Sk", "Mn", "Me", "Cf", "Cs", "Co"):
+        return ""
+    return None
+
+def transliterate(text):
+    """text in GSM 03.38 and whether more than typography was lost, or
+    None if it has letters that would have to go"""
+    out = []
+    lossy = False
+    for char in text:
+        replacement = transliterate_char(char)
+        if replacement is None:
+            return None
+        lossy = lossy or (replacement != char and char not in TRANSLITERATIONS)
+        out.append(replacement)
+    return "".join(out), lossy
+
+def compact(text):
+    """Collapses runs of whitespace and blank lines and drops the signature"""
+    text = SIGNATURE.sub("", text)
+    text = HORIZONTAL_SPACE.sub(" ", text)
+    text = LINE_BREAKS.sub("\n", text)
+    return text.strip()
+
+def segments(length, single, multi):
+    return 1 if length <= single else -(-length // multi)
+
+class TextPlanner():
+    """Chooses between GSM 03.38, GSM 03.38 after transliteration and
+    UCS-2, whichever needs the fewest segments, and truncates to a
+    budget of maxsegments
+
+    The outcome is plain text: when it is all GSM 03.38 it will be
+    encoded as such, otherwise as UCS-2.
+    """
+    def __init__(self, maxsegments=10, transliterate=True):
+        self.maxsegments = maxsegments
+        self.transliterate = transliterate
+
+    def candidates(self, text):
+        """(segments, lossy, text, cost, single, multi) for each usable encoding"""
+        if all(is_gsm(c) for c in text):
+            septets = sum(gsm_cost(c) for c in text)
+            yield segments(septets, GSM_SINGLE, GSM_MULTI), False, text, gsm_cost, GSM_SINGLE, GSM_MULTI
+            return
+        transliterated = transliterate(text) if self.transliterate else None
+        if transliterated is not None and compact(transliterated[0]):
+            gsmtext, lossy = compact(transliterated[0]), transliterated[1]
+            septets = sum(gsm_cost(c) for c in gsmtext)
+            yield segments(septets, GSM_SINGLE, GSM_MULTI), lossy, gsmtext, gsm_cost, GSM_SINGLE, GSM_MULTI
+        octets = sum(ucs2_cost(c) for c in text)
+        yield segments(octets, UCS2_SINGLE, UCS2_MULTI), False, text, ucs2_cost, UCS2_SINGLE, UCS2_MULTI
+
+    def truncate(self, text, cost, single, multi, ellipsis, slack=0):
+        """text cut at a word boundary, with ellipsis, to fit the budget"""
+        budget = single if self.maxsegments == 1 else multi * self.maxsegments
+        budget -= sum(cost(c) for c in ellipsis) + slack
+        used = 0
+        for end, char in enumerate(text):
+            used += cost(char)
+            if used > budget:
+                break
+        else:
+            end = len(text)
+        cut = max(text.rfind(" ", 0, end + 1), text.rfind("\n", 0, end + 1))
+        if cut > 0 and cut > end - 20:
+            end = cut
+        return text[:end].rstrip() + ellipsis
+
+    def plan(self, text):
+        text = compact(text)
+        # Fewest segments. On a tie, typographic look-alikes go to GSM
+        # 03.38, but accents and emoji are kept in UCS-2.
+        count, lossy, text, cost, single, multi = min(self.candidates(text), key=lambda candidate: candidate[:2])
+        if not self.maxsegments or count <= self.maxsegments:
+            return text
+        ellipsis = "..." if cost is gsm_cost else "…"
+        truncated = self.truncate(text, cost, single, multi, ellipsis)
+        # characters that take two septets or four octets are never split
+        # across parts, which can leave a part short
+        slack = 0
+        while len(smsutil.split(truncated).parts) > self.maxsegments:
+            slack += 4
+            truncated = self.truncate(text, cost, single, multi, ellipsis, slack)
+        return truncated
+
+    def __call__(self, text):
+        return self.plan(text)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+import time
+import struct
+
+TX = 0
+RX = 1
+
+# timestamp, direction, length of data
+HEADER = struct.Struct("<dBH")
+
+class WireTrace():
+    """Fixed size ring buffer of timestamped serial frames
+
+    Recording copies the frame into a preallocated bytearray, dropping
+    the oldest frames to make room. Nothing is formatted until the
+    trace is dumped.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.buf = bytearray(size)
+        self.start = 0
+        self.used = 0
+        self.lastdump = 0
+
+    def put(self, offset, data):
+        end = offset + len(data)
+        if end <= self.size:
+            self.buf[offset:end] = data
+        else:
+            split = self.size - offset
+            self.buf[offset:] = data[:split]
+            self.buf[:end - self.size] = data[split:]
+
+    def get(self, offset, length):
+        end = offset + length
+        if end <= self.size:
+            return bytes(self.buf[offset:end])
+        return bytes(self.buf[offset:]) + bytes(self.buf[:end - self.size])
+
+    def record(self, direction, data):
+        data = data[:self.size - HEADER.size]
+        length = HEADER.size + len(data)
+        while self.size - self.used < length:
+            # drop the oldest frame
+            timestamp, d, oldlength = HEADER.unpack(self.get(self.start, HEADER.size))
+            self.start = (self.start + HEADER.size + oldlength) % self.size
+            self.used -= HEADER.size + oldlength
+        end = (self.start + self.used) % self.size
+        self.put(end, HEADER.pack(time.time(), direction, len(data)))
+        self.put((end + HEADER.size) % self.size, data)
+        self.used += length
+
+    def frames(self, since=0):
+        """(timestamp, direction, data) of every frame after since, oldest first"""
+        offset = self.start
+        remaining = self.used
+        while remaining > 0:
+            timestamp, direction, length = HEADER.unpack(self.get(offset, HEADER.size))
+            if timestamp > since:
+                yield timestamp, direction, self.get((offset + HEADER.size) % self.size, length)
+            offset = (offset + HEADER.size + length) % self.size
+            remaining -= HEADER.size + length
+
+    def dump(self, logger, name, new_only=False):
+        """Log the frames, or only those since the last dump"""
+        since = self.lastdump if new_only else 0
+        for timestamp, direction, data in self.frames(since):
+            logger.info("{}.{:03d} {} {} {!r}".format(
+                time.strftime("%H:%M:%S", time.localtime(timestamp)), int(timestamp * 1000) % 1000,
+                name, "TX" if direction == TX else "RX", data))
+        self.lastdump = time.time()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+__all__ = ["MetricsExporter"]
+
+import os
+import asyncio
+import logging
+
+from ._private.metrics import registry
+
+class MetricsExporter():
+    """Publishes the metrics in Prometheus text format
+
+    Either as a file rewritten every interval seconds (for the node
+    exporter textfile collector) or on a Unix socket of its own that
+    answers every connection with the current metrics.
+    """
+    def __init__(self, metricsconf):
+        self.textfile = metricsconf.get("textfile")
+        self.socketpath = metricsconf.get("socket")
+        self.interval = float(metricsconf.get("interval", 15))
+        self.logger = logging.getLogger("metrics")
+        self.server = None
+        self.writer = None
+
+    def write(self):
+        tmp = "{}.tmp".format(self.textfile)
+        with open(tmp, "w") as f:
+            f.write(registry.render())
+        os.rename(tmp, self.textfile)
+
+    async def writeperiodically(self):
+        while True:
+            try:
+                self.write()
+            except OSError as e:
+                self.logger.error("Could not write {}: {}".format(self.textfile, e))
+            await asyncio.sleep(self.interval)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            writer.write(registry.render().encode("utf-8"))
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self):
+        if self.textfile:
+            self.writer = asyncio.ensure_future(self.writeperiodically())
+        if self.socketpath:
+            if os.path.exists(self.socketpath):
+                os.unlink(self.socketpath)
+            self.server = await asyncio.start_unix_server(self.handle_connection, path=self.socketpath)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+__all__ = ["Profiler"]
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import collections
+
+class Sampler(threading.Thread):
+    """Samples the stacks of every thread, serial threads included, as
+    collapsed stacks for flamegraph.pl and the like"""
+    def __init__(self, interval):
+        super().__init__(name="profiler", daemon=True)
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopping = threading.Event()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+
+class Profiler():
+    """Profiles the next messages through SMSGateway.process_messages
+
+    Switched on with SIGUSR2 or a "start" on the control socket. While
+    off, nothing of it is on the message path: switching on puts a
+    wrapper over the gateway's process_messages, and the wrapper takes
+    itself away after the last message.
+
+    With cProfile only the event loop thread is profiled, where
+    messages are parsed and encoded. The sampler sees every thread,
+    the waits for the modems on the serial threads among them.
+    Results go to the directory as .pstats, .folded (collapsed stacks)
+    and, with tracemalloc, a .tracemalloc snapshot.
+    """
+    def __init__(self, profileconf, gateway):
+        self.gateway = gateway
+        self.logger = logging.getLogger("profiling")
+        self.server = None
+        self.running = None
+        self.runs = 0
+        self.configure(profileconf)
+
+    def configure(self, profileconf):
+        """Defaults for the next run"""
+        self.directory = profileconf.get("directory", "/var/lib/lmtpsmsd/profiles")
+        self.socketpath = profileconf.get("socket")
+        self.settings = {
+            "messages": int(profileconf.get("messages", 100)),
+            "mode": profileconf.get("mode", "cprofile"),
+            "interval": float(profileconf.get("interval", 0.005)),
+            "tracemalloc": str(profileconf.get("tracemalloc", "no")).lower() in ("yes", "true", "on", "1"),
+        }
+
+    def status(self):
+        if self.running is None:
+            return "idle"
+        return "profiling with {}, {} of {} messages".format(
+            self.running["mode"], self.running["done"], self.running["messages"])
+
+    def begin(self, **overrides):
+        if self.running is not None:
+            return self.status()
+        settings = dict(self.settings, **overrides)
+        if settings["mode"] not in ("cprofile", "sample"):
+            raise ValueError("mode is cprofile or sample")
+        running = self.running = dict(settings, done=0, started=None)
+        original = self.gateway.process_messages
+        async def process_messages(*args):
+            if running["started"] is None:
+                self.collect(running)
+            try:
+                return await original(*args)
+            finally:
+                running["done"] += 1
+                # messages still under way when it ended count for nothing
+                if running["done"] >= running["messages"] and self.running is running:
+                    self.end()
+        self.gateway.process_messages = process_messages
+        self.logger.info(self.status())
+        return self.status()
+
+    def collect(self, running):
+        """Collectors start with the first message, not while waiting for it"""
+        running["started"] = time.time()
+        if running["tracemalloc"]:
+            import tracemalloc
+            tracemalloc.start(25)
+        if running["mode"] == "cprofile":
+            import cProfile
+            running["profile"] = cProfile.Profile()
+            running["profile"].enable()
+        else:
+            running["sampler"] = Sampler(running["interval"])
+            running["sampler"].start()
+
+    def end(self):
+        """Stops collecting and writes out what there is, in the background"""
+        running = self.running
+        if running is None:
+            return "idle"
+        self.running = None
+        del self.gateway.process_messages
+        if running["started"] is None:
+            return "stopped before any message"
+        if "profile" in running:
+            running["profile"].disable()
+        if "sampler" in running:
+            running["sampler"].stop()
+        snapshot = None
+        if running["tracemalloc"]:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        self.runs += 1
+        base = os.path.join(self.directory, "lmtpsmsd-{}-{}-{}".format(
+            time.strftime("%Y%m%d-%H%M%S", time.localtime(running["started"])), os.getpid(), self.runs))
+        asyncio.get_running_loop().run_in_executor(None, self.write, base, running, snapshot)
+        return "writing {}.*".format(base)
+
+    def write(self, base, running, snapshot):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if "profile" in running:
+                running["profile"].dump_stats(base + ".pstats")
+            if "sampler" in running:
+                running["sampler"].write(base + ".folded")
+            if snapshot is not None:
+                snapshot.dump(base + ".tracemalloc")
+            self.logger.info("Profile of {} messages written to {}.*".format(running["done"], base))
+        except OSError as e:
+            self.logger.error("Could not write profile: {}".format(e))
+
+    def toggle(self):
+        """For SIGUSR2, start with the defaults or stop early"""
+        if self.running is None:
+            self.begin()
+        else:
+            self.logger.info(self.end())
+
+    def command(self, line):
+        """start [messages=N] [mode=cprofile|sample] [interval=S] [tracemalloc=yes], stop or status"""
+        words = line.split()
+        if not words or words[0] == "status":
+            return self.status()
+        if words[0] == "stop":
+            return self.end()
+        if words[0] != "start":
+            return "unknown command {}".format(words[0])
+        overrides = {}
+        for word in words[1:]:
+            key, equals, value = word.partition("=")
+            if key not in self.settings:
+                return "unknown setting {}".format(key)
+            if key == "tracemalloc":
+                overrides[key] = value.lower() in ("yes", "true", "on", "1")
+            else:
+                overrides[key] = type(self.settings[key])(value)
+        return self.begin(**overrides)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            line = (await reader.readline()).decode("utf-8", errors="replace")
+            try:
+                reply = self.command(line)
+            except ValueError as e:
+                reply = "{}".format(e)
+            writer.write("{}\n".format(reply).encode("utf-8"))
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self):
+        if self.socketpath:
+            if os.path.exists(self.socketpath):
+                os.unlink(self.socketpath)
+            self.server = await asyncio.start_unix_server(self.handle_connection, path=self.socketpath)
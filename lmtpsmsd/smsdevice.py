@@ -24,23 +24,141 @@
 
 from __future__ import print_function, unicode_literals
 
-__all__ = ["SMSDevice"]
+__all__ = ["SMSDevice", "SMSDevicePool"]
 
+import asyncio
+import concurrent.futures
+import contextlib
 import logging
 import time
 
-from ._private.atmodem import ATSerial
+from ._private.modemstate import ModemState, NetworkState, NotRegistered, MessageRejected
+from ._private.commandtimeouts import CommandTimeouts
+from ._private.wiretrace import WireTrace
+from ._private import metrics
+
+# [modem] settings the serial session is set up with, the others apply
+# without reconnecting
+SESSION_SETTINGS = ("pin", "cmee", "tracebytes")
+
+# seconds between polls of a modem that has lost the network, and
+# between reads of the unsolicited reports of an idle one
+REGISTRATION_POLL = 5
 
 class SMSDevice():
-    def __init__(self, serialconf, modemconf):
+    def __init__(self, serialconf, modemconf, name="modem"):
         self.atmodem = None
-        self.serialconf = serialconf
-        self.modemconf = modemconf
-        self.logger = logging.getLogger("sms")
+        self.name = name
+        self.logger = logging.getLogger("sms.{}".format(name))
         self.errors = 0
+        self.failures = 0
+        self.unhealthy_until = 0
+        self.busy = 0
+        self.lastactivity = time.monotonic()
+        self.tracebytes = None
+        self.configure(serialconf, modemconf)
+        self.modemstate = ModemState()
+        self.network = NetworkState()
+        # response times learned on this modem outlast its sessions
+        self.timeouts = CommandTimeouts()
+        self.lastpoll = 0
+        # what connect() is up to, for STATUS=
+        self.status = "not connected"
+        self.onprogress = None
+        # All serial I/O happens on this one thread, so the event loop
+        # never blocks on the modem and commands never interleave.
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    def configure(self, serialconf, modemconf):
+        """The serial and session settings take effect on the next connect()"""
+        self.serialconf = dict(serialconf)
+        self.modemconf = dict(modemconf)
+        self.maxfailures = int(modemconf.get("maxfailures", 3))
+        self.cooldown = int(modemconf.get("cooldown", 60))
+        # ping only after this many seconds without successful traffic
+        self.keepalive = int(modemconf.get("keepalive", 60))
+        tracebytes = int(modemconf.get("tracebytes", 0))
+        if self.tracebytes != tracebytes:
+            self.tracebytes = tracebytes
+            self.trace = WireTrace(tracebytes) if tracebytes > 0 else None
+
+    async def reconfigure(self, serialconf, modemconf):
+        """Reopens the serial session only if its settings changed, after
+        whatever exchange is in progress on the serial thread"""
+        serialconf, modemconf = dict(serialconf), dict(modemconf)
+        def session(modemconf):
+            return {k: modemconf.get(k) for k in SESSION_SETTINGS}
+        if serialconf == self.serialconf and session(modemconf) == session(self.modemconf):
+            self.configure(serialconf, modemconf)
+            return
+        self.logger.info("Serial settings changed, reconnecting")
+        def apply():
+            self.disconnect()
+            # possibly another modem or SIM behind the new settings
+            self.modemstate.invalidate()
+            self.network = NetworkState()
+            self.configure(serialconf, modemconf)
+            self.connect()
+        await self.call(apply)
+
+    async def call(self, fn, *args):
+        """Run fn(*args) on the serial thread"""
+        self.busy += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.busy -= 1
+
+    def healthy(self):
+        return time.monotonic() >= self.unhealthy_until
+
+    def available(self):
+        """Healthy and, as far as is known, registered with the network"""
+        return self.healthy() and self.network.registered() is not False
+
+    def pollinterval(self):
+        # every few seconds while waiting to get back on the network
+        if self.network.registered() is False:
+            return min(self.keepalive, REGISTRATION_POLL)
+        return self.keepalive
+
+    def polldue(self):
+        now = time.monotonic()
+        return (now - self.lastactivity >= self.pollinterval()
+                or now - self.lastpoll >= self.keepalive)
+
+    def succeeded(self):
+        self.failures = 0
+        self.lastactivity = time.monotonic()
+
+    def idle(self):
+        return time.monotonic() - self.lastactivity
+
+    def alive(self):
+        """Connected and heard from recently enough"""
+        return self.atmodem is not None and self.idle() < 3 * self.keepalive
+
+    def failed(self):
+        # a single timeout or error result says nothing about a reset,
+        # but a modem that keeps failing is set up from scratch
+        if self.failures:
+            self.modemstate.invalidate()
+        self.errors += 1
+        self.failures += 1
+        if self.failures >= self.maxfailures:
+            self.logger.warning("Out of rotation for {} s after {} failures".format(self.cooldown, self.failures))
+            self.unhealthy_until = time.monotonic() + self.cooldown
+
+    def progress(self, status):
+        self.status = status
+        if self.onprogress is not None:
+            self.onprogress()
 
     def connect(self):
         if self.atmodem is None:
+            # pyserial is only needed once there is a modem to talk to
+            from ._private.atmodem import ATSerial
+
             def todict(d):
                 r = {}
                 for k in d:
@@ -57,24 +175,96 @@ class SMSDevice():
             toint('stopbits')
 
             # This will get an exclusive lock on the device.
-            ser = ATSerial(dev, serial_speed, **serialconf)
+            self.progress("opening {}".format(dev))
+            ser = None
+            started = time.perf_counter()
             try:
+                ser = ATSerial(dev, serial_speed, trace=self.trace, state=self.modemstate, network=self.network,
+                             timeouts=self.timeouts, **serialconf)
                 self.logger.info("Connecting")
 
                 ser.__enter__()
-                time.sleep(1)
-                ser.reset()
-                ser.send("")
-                ser.ping()
-                ser.setspeed(serial_speed)
-                ser.auth(self.modemconf["pin"])
+                self.setup(ser)
                 self.atmodem = ser
+                metrics.reconnects.inc()
+                metrics.connect_seconds.observe(time.perf_counter() - started)
+                self.lastactivity = time.monotonic()
 
-                self.logger.info("Connected")
+                self.logger.info("Connected, {}".format(self.network.describe()))
+                self.progress("ready")
+                # held only for each exchange from now on
+                ser.release()
             finally:
                 if self.atmodem is None:
                     # failed
-                    ser.__exit__()
+                    self.modemstate.invalidate()
+                    self.progress("not connected")
+                    if ser is not None:
+                        ser.__exit__()
+
+    def setup(self, ser):
+        """Bring the modem to a known state, skipping what the modem state
+        says is already done"""
+        if not self.modemstate.known():
+            # unknown state, maybe halfway into an AT+CMGS
+            self.progress("probing")
+            ser.probe()
+        else:
+            ser.ping()
+        self.progress("setting speed")
+        ser.setspeed(self.serialconf["speed"])
+        self.progress("unlocking SIM")
+        ser.auth(self.modemconf["pin"])
+        ser.seterrorreporting(self.modemconf.get("cmee", 1))
+        self.progress("checking registration")
+        ser.enablenetworkreports()
+        ser.poll()
+        self.lastpoll = time.monotonic()
+
+    @contextlib.contextmanager
+    def session(self):
+        """The serial lock for one exchange with the modem, so that
+        lmtpsmsd-bulk and the daemon can take turns on the same modem"""
+        if not self.atmodem.acquire(blocking=False):
+            self.logger.info("Waiting for another process to release the modem")
+            self.progress("in use by another process")
+            self.atmodem.acquire()
+            # the other process may have changed any setting or reset the modem
+            self.modemstate.invalidate()
+            try:
+                self.setup(self.atmodem)
+            except Exception:
+                self.atmodem.release()
+                raise
+            self.progress("ready")
+        try:
+            yield self.atmodem
+        finally:
+            self.atmodem.release()
+
+    def readreports(self):
+        """Take in the registration reports of an idle modem, on the serial thread"""
+        if self.atmodem is None:
+            return
+        success = False
+        try:
+            if self.atmodem.in_waiting:
+                with self.session() as atmodem:
+                    atmodem.discard()
+            success = True
+        except OSError:
+            # unplugged, most likely
+            self.modemstate.invalidate()
+            raise
+        finally:
+            if not success:
+                self.disconnect()
+                self.failed()
+
+    def dumptrace(self, new_only=False):
+        """Log the recorded serial conversation, call on the serial thread"""
+        if self.trace is not None:
+            self.trace.dump(logging.getLogger("wiretrace"), self.name, new_only)
 
     def disconnect(self):
         if self.atmodem is not None:
@@ -82,29 +272,174 @@ class SMSDevice():
 
             self.atmodem.__exit__()
             self.atmodem = None
+            self.progress("not connected")
 
     def sendpdusms(self, *args, **kwargs):
-        self.connect()
         success = False
         try:
+            self.connect()
             self.logger.info("Sending SMS")
 
-            self.atmodem.ping()
-            self.atmodem.sendpdusms(*args, **kwargs)
+            with self.session() as atmodem:
+                atmodem.sendpdusms(*args, **kwargs)
             success = True
+        except NotRegistered:
+            # the modem is fine, it is held until it registers again
+            self.logger.warning("Not registered with the network")
+            success = None
+            raise
+        except MessageRejected:
+            # answered properly, only the message failed
+            self.succeeded()
+            success = None
+            raise
+        except OSError:
+            # unplugged, whatever comes back is set up from scratch
+            self.modemstate.invalidate()
+            raise
         finally:
-            if not success:
+            if success:
+                self.succeeded()
+            elif success is False:
                 self.disconnect()
-                self.errors += 1
+                self.failed()
 
     def ping(self):
-        self.connect()
+        """Keepalive, with registration and signal refreshed"""
         success = False
         try:
-            self.atmodem.ping()
+            self.connect()
+            with self.session() as atmodem:
+                atmodem.poll()
+            self.lastpoll = time.monotonic()
             success = True
+        except OSError:
+            self.modemstate.invalidate()
+            raise
         finally:
-            if not success:
+            if success:
+                self.succeeded()
+            else:
                 self.disconnect()
-                self.errors += 1
+                self.failed()
+
+class SMSDevicePool():
+    """Several modems, each message goes to the least busy healthy one"""
+    @staticmethod
+    def sections(conf):
+        """[serial]/[modem] plus any number of [serial.NAME]/[modem.NAME] pairs"""
+        for section in conf.sections():
+            if section == "serial" or section.startswith("serial."):
+                suffix = section[len("serial"):]
+                yield suffix[1:] or "modem", conf[section], conf["modem" + suffix]
+
+    @classmethod
+    def fromconfig(cls, conf):
+        return cls([SMSDevice(serialconf, modemconf, name=name) for name, serialconf, modemconf in cls.sections(conf)])
+
+    async def reconfigure(self, conf):
+        """Applies changed [serial]/[modem] settings, modems only come and
+        go with a restart"""
+        sections = {name: (serialconf, modemconf) for name, serialconf, modemconf in self.sections(conf)}
+        if set(sections) != set(device.name for device in self.devices):
+            self.logger.warning("Adding or removing modems takes effect after a restart")
+        devices = [device for device in self.devices if device.name in sections]
+        results = await asyncio.gather(*[device.reconfigure(*sections[device.name]) for device in devices],
+                                       return_exceptions=True)
+        for device, result in zip(devices, results):
+            if isinstance(result, Exception):
+                # the drainers try again when there is something to send
+                device.logger.error("Could not reconnect: {}".format(result))
+                device.failed()
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.logger = logging.getLogger("sms")
+        metrics.registry.gauge("lmtpsmsd_modem_errors_total", "Failed modem operations", lambda: [
+            ({"modem": device.name}, device.errors) for device in self.devices], type="counter")
+        metrics.registry.gauge("lmtpsmsd_modem_healthy", "Whether the modem is in rotation", lambda: [
+            ({"modem": device.name}, int(device.healthy())) for device in self.devices])
+        metrics.registry.gauge("lmtpsmsd_modem_busy", "Modem operations in flight", lambda: [
+            ({"modem": device.name}, device.busy) for device in self.devices])
+        metrics.registry.gauge("lmtpsmsd_modem_registered", "Whether the modem is registered with a network", lambda: [
+            ({"modem": device.name}, int(device.network.registered())) for device in self.devices
+            if device.network.registered() is not None])
+        metrics.registry.gauge("lmtpsmsd_modem_command_timeout_seconds", "Current deadline per AT command type", lambda: [
+            ({"modem": device.name, "command": kind}, estimate.timeout) for device in self.devices
+            for kind, estimate in device.timeouts.items()])
+        metrics.registry.gauge("lmtpsmsd_modem_signal_dbm", "Signal strength from AT+CSQ", lambda: [
+            ({"modem": device.name}, device.network.dbm()) for device in self.devices
+            if device.network.dbm() is not None])
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def pick(self):
+        available = [device for device in self.devices if device.available()]
+        if not available:
+            return None
+        return min(available, key=lambda device: device.busy)
+
+    def retry_delay(self):
+        """Seconds until the first unhealthy or unregistered modem may be
+        back, the keepalive polls those without registration"""
+        now = time.monotonic()
+        return max(0, min(device.unhealthy_until - now if not device.healthy() else 1 for device in self.devices))
+
+    async def connect(self):
+        results = await asyncio.gather(*[device.call(device.connect) for device in self.devices], return_exceptions=True)
+        for device, result in zip(self.devices, results):
+            if isinstance(result, Exception):
+                device.logger.error("Could not connect: {}".format(result))
+                device.failed()
+        if all(isinstance(result, Exception) for result in results):
+            raise Exception("No modem could be connected")
+
+    async def ping(self, devices=None):
+        if devices is None:
+            devices = [device for device in self.devices if device.healthy() and device.busy == 0]
+        results = await asyncio.gather(*[device.call(device.ping) for device in devices], return_exceptions=True)
+        for device, result in zip(devices, results):
+            if isinstance(result, Exception):
+                device.logger.error("Ping failed: {}".format(result))
+
+    async def keepalive(self):
+        """Ping each modem once it has been idle for its keepalive period,
+        any successful traffic counts as being alive. Signal and
+        registration are polled at least that often too, and every few
+        seconds while a modem is not registered."""
+        while True:
+            idle = [device for device in self.devices if device.healthy() and device.busy == 0]
+            due = [device for device in idle if device.polldue()]
+            if due:
+                await self.ping(due)
+            for device in idle:
+                if device not in due:
+                    try:
+                        await device.call(device.readreports)
+                    except Exception as e:
+                        device.logger.error("Reading reports failed: {}".format(e))
+            now = time.monotonic()
+            wait = min(max(min(device.lastactivity + device.pollinterval(), device.lastpoll + device.keepalive),
+                           device.unhealthy_until) - now
+                       for device in self.devices)
+            await asyncio.sleep(min(max(1, wait), REGISTRATION_POLL))
+
+    def alive(self):
+        return any(device.alive() for device in self.devices)
+
+    def status(self):
+        return ", ".join(" ".join(filter(None, (device.name, device.status, device.network.describe())))
+                         for device in self.devices)
+
+    async def dumptrace(self):
+        for device in self.devices:
+            await device.call(device.dumptrace)
+
+    def disconnect(self):
+        for device in self.devices:
+            device.disconnect()
 
@@ -27,41 +27,415 @@ from __future__ import print_function, unicode_literals
 __all__ = ["SMSGateway"]
 
 import sys
+import time
+import asyncio
 import logging
-import email
 
 from ._private.socketlmtpd import LMTPSocketServer
+from ._private import pdu
+from ._private import metrics
 from ._private.pdu import TextMessage
+from ._private.stormcontrol import StormControl
+from ._private import scheduler
+from ._private.scheduler import Scheduler
+from ._private.textplan import TextPlanner
+from ._private.directory import Directory, NUMBER
+from ._private.modemstate import NotRegistered, MessageRejected
+
+# most spooled messages a drainer sends in one modem session
+MAX_BATCH = 16
 
 class SMSGateway(LMTPSocketServer):
-    """LMTP socket server with SMS delivery"""
-    def __init__(self, smsdevice, *args, **kwargs):
+    """LMTP socket server with SMS delivery through a durable spool"""
+    def __init__(self, smsdevices, spool, *args, cacheconf=None, stormconf=None, priorityconf=None, messageconf=None, directoryconf=None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.smsdevice = smsdevice
+        self.smsdevices = smsdevices
+        self.spool = spool
+        self.storm = None
+        self.queue = Scheduler()
+        self.directory = None
+        self.drainers = []
         self.logger = logging.getLogger("smsgateway")
+        self.configure(cacheconf, stormconf, priorityconf, messageconf, directoryconf, maxsize=kwargs.get("maxsize"))
+        metrics.registry.gauge("lmtpsmsd_queue_depth", "Spooled messages waiting for a modem", lambda: [
+            ({"class": name}, size) for name, size in self.queue.sizes().items()])
+        metrics.registry.gauge("lmtpsmsd_lmtp_connections_total", "LMTP connections accepted", lambda: [
+            ({"listener": name}, count) for name, count in self.connections.items()], type="counter")
+        metrics.registry.gauge("lmtpsmsd_cache_hits_total", "Encoding cache hits", lambda: [
+            ({"cache": name}, stats["hits"]) for name, stats in self.cachestats().items()], type="counter")
+        metrics.registry.gauge("lmtpsmsd_cache_misses_total", "Encoding cache misses", lambda: [
+            ({"cache": name}, stats["misses"]) for name, stats in self.cachestats().items()], type="counter")
+
+    def configure(self, cacheconf=None, stormconf=None, priorityconf=None, messageconf=None, directoryconf=None, maxsize=None):
+        """Applies the settings to messages from now on, also on reload.
+        Nothing awaits in here, so a message in progress sees either the
+        old settings or the new ones. Returns True if the directory
+        changed and needs refresh_directory()."""
+        messageconf = messageconf or {}
+        self.maxsize = int(messageconf.get("maxsize", 0)) if maxsize is None else maxsize
+        maxsegments = int(messageconf.get("maxsegments", 10))
+        # concatenated parts hold fewer, but never more, characters
+        self.maxchars = 160 * maxsegments
+        transliterate = str(messageconf.get("transliterate", "yes")).lower() in ("yes", "true", "on", "1")
+        self.planner = TextPlanner(maxsegments, transliterate)
+        if cacheconf is not None:
+            pdu.configure_caches(cacheconf)
+        if stormconf is None:
+            self.storm = None
+        elif self.storm is None:
+            self.storm = StormControl(stormconf)
+        else:
+            # keeps what is being held back
+            self.storm.configure(stormconf)
+        self.queue.configure(priorityconf)
+        if directoryconf is None:
+            self.directory = None
+            return False
+        directory = Directory(directoryconf)
+        if self.directory is not None and (directory.source, directory.indexpath) == (self.directory.source, self.directory.indexpath):
+            self.directory.interval = directory.interval
+            return False
+        self.directory = directory
+        return True
+
+    async def reload(self, *args, **kwargs):
+        if self.configure(*args, **kwargs):
+            await self.refresh_directory()
+
+    def enqueue(self, entry):
+        """Into the scheduler, or once its rate limit delay is over"""
+        delay = entry.notbefore - time.time() if entry.notbefore is not None else 0
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self.queue.put_nowait, entry)
+        else:
+            self.queue.put_nowait(entry)
 
-    def process_message(self, peer, mailfrom, rcptto, data):
-        number = rcptto.decode("ascii").lstrip("<").rstrip(">").split("@")[0]
+    def cachestats(self):
+        return {"destinations": pdu.destinations.stats(), "bodies": pdu.bodies.stats()}
 
-        self.logger.info("Process message to {}:".format(number))
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for entry in await loop.run_in_executor(None, self.spool.recover):
+            self.enqueue(entry)
+        # one drainer per modem keeps every modem busy
+        self.drainers = [self.spawn(self.drain) for device in self.smsdevices]
+        # both run even when off, as a reload may turn them on
+        self.drainers.append(self.spawn(self.summarize))
+        if self.directory is not None:
+            await self.refresh_directory()
+        self.drainers.append(self.spawn(self.watch_directory))
+        await super().start()
+
+    def spawn(self, fn):
+        """Runs fn() as a task that is started again should it ever die"""
+        task = asyncio.ensure_future(fn())
+        def restart(task):
+            if task.cancelled():
+                return
+            self.logger.error("{} stopped, restarting it: {!r}".format(fn.__name__, task.exception()))
+            def again():
+                self.drainers[self.drainers.index(task)] = self.spawn(fn)
+            asyncio.get_running_loop().call_later(1, again)
+        task.add_done_callback(restart)
+        return task
+
+    async def refresh_directory(self):
+        """Compiles the directory off the event loop, keeps the old index if it fails"""
+        directory = self.directory
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, directory.refresh)
+        except Exception as e:
+            self.logger.error("Directory {}: {}".format(directory.source, e))
 
-        msg = email.message_from_bytes(data)
+    async def watch_directory(self):
+        while True:
+            directory = self.directory
+            await asyncio.sleep(directory.interval if directory is not None else 5)
+            if directory is not None and directory is self.directory and directory.stale():
+                await self.refresh_directory()
+
+    def deliver(self, smsdevice, entries):
+        """Runs on the serial thread, journals each part as soon as it is
+        out, and gives way between entries to a more urgent message"""
+        unsent = [(entry, i, part) for entry in entries for i, part in entry.unsent()]
+        def onsent(n):
+            entry, i, part = unsent[n]
+            self.spool.mark_sent(entry, i)
+            metrics.parts.inc()
+            # a modem that gets parts out is working, whatever fails later
+            smsdevice.succeeded()
+            if entry.done():
+                # only a peek at the queue from this thread, a message
+                # that is missed waits for the next entry
+                waiting = self.queue.nextpriority()
+                return waiting is None or waiting >= entry.priority
+        smsdevice.sendpdusms([part for entry, i, part in unsent], onsent)
+
+    def batch(self, entry):
+        """entry and whatever else is waiting in its class, to go out in
+        one modem session"""
+        entries = [entry]
+        # leave a fair share of the queue for the other modems
+        limit = min(MAX_BATCH, -(-(self.queue.qsize() + 1) // len(self.smsdevices)))
+        while len(entries) < limit and self.queue.nextpriority() == entry.priority:
+            entries.append(self.queue.get_nowait())
+        return entries
+
+    async def expire(self, entries):
+        """Moves the stale ones among entries out of the spool, returns the rest"""
+        now = time.time()
+        live = [entry for entry in entries if not entry.expired(now)]
+        for entry in entries:
+            if entry.expired(now):
+                self.logger.warning("Dropping {} to {}, past its deadline".format(entry.name, entry.number))
+                metrics.expired.inc()
+                await asyncio.get_running_loop().run_in_executor(None, self.spool.fail, entry)
+        return live
+
+    async def drain(self):
+        failures = 0
+        while True:
+            entries = []
+            try:
+                entries = self.batch(await self.queue.get())
+                entries = await self.expire(entries)
+                if entries:
+                    failures = await self.send(entries, failures)
+            except Exception as e:
+                # a bug or a spool I/O error, the entries stay queued
+                self.logger.exception("Draining failed: {}".format(e))
+                for entry in entries:
+                    if not entry.done():
+                        self.queue.put_nowait(entry)
+                failures += 1
+                await asyncio.sleep(min(2 ** failures, 60))
+
+    async def send(self, entries, failures):
+        """One modem session for entries, returns the new count of
+        consecutive failures"""
+        loop = asyncio.get_running_loop()
+        smsdevice = self.smsdevices.pick()
+        while smsdevice is None:
+            await asyncio.sleep(self.smsdevices.retry_delay())
+            smsdevice = self.smsdevices.pick()
+        sent = sum(len(entry.sent) for entry in entries)
+        try:
+            await smsdevice.call(self.deliver, smsdevice, entries)
+            # what a more urgent message cut short goes out next in its class
+            self.queue.putback([entry for entry in entries if not entry.done()])
+            return 0
+        except NotRegistered:
+            # held without an attempt counted, pick() passes over
+            # the modem until it is registered again
+            for entry in entries:
+                if not entry.done():
+                    self.queue.put_nowait(entry)
+            return failures
+        except Exception as e:
+            metrics.sendfailures.inc()
+            # parts go out in order, so the first unfinished entry is
+            # the one that failed and the rest were never tried
+            unfinished = [entry for entry in entries if not entry.done()]
+            if not unfinished:
+                # every part is out, it was the journal that failed
+                raise
+            await smsdevice.call(smsdevice.dumptrace, True)
+            failed = unfinished[0]
+            self.logger.error("Sending to {} via {} failed: {}".format(failed.number, smsdevice.name, e))
+            failed.attempts += 1
+            if failed.attempts >= self.spool.maxattempts:
+                self.logger.error("Giving up on {} after {} attempts".format(failed.name, failed.attempts))
+                await loop.run_in_executor(None, self.spool.fail, failed)
+                unfinished = unfinished[1:]
+            for entry in unfinished:
+                self.queue.put_nowait(entry)
+            if isinstance(e, MessageRejected):
+                # the modem is fine, the rest go out straight away
+                return 0
+        # back off only while nothing gets through
+        if sum(len(entry.sent) for entry in entries) > sent:
+            return 0
+        await asyncio.sleep(min(2 ** (failures + 1), 60))
+        return failures + 1
+
+    def recipient(self, rcptto):
+        """number or directory name and the priority class name from its
+        address extension, if any, or None for an address that is not ASCII"""
+        try:
+            localpart = rcptto.decode("ascii").lstrip("<").rstrip(">").split("@")[0]
+        except UnicodeDecodeError:
+            return None
+        return scheduler.split_extension(localpart)
+
+    def resolve(self, name):
+        """The numbers for a recipient, None if the directory has no such name"""
+        if self.directory is None:
+            return [name]
+        numbers = self.directory.lookup(name)
+        if numbers is None and NUMBER.match(name):
+            return [name]
+        return numbers
+
+    def dataparser(self):
+        # the email package is imported with the first message, not at startup
+        from ._private.mimeextract import MIMEExtractor
+        return MIMEExtractor(self.maxchars)
+
+    def extract(self, data):
+        """data is an MIMEExtractor fed over LMTP, or the whole message"""
+        with metrics.parse_seconds.time():
+            if isinstance(data, bytes):
+                extractor = self.dataparser()
+                for line in data.split(b"\n"):
+                    extractor.feed(line.rstrip(b"\r"))
+                data = extractor.close()
+            return self.extract_text(data)
+
+    def extract_text(self, extractor):
+        msg = extractor.headers
 
         sender = str(msg.get('From'))
         sender = (sender.split("<")[1].split(">")[0]) if "<" in sender else sender
         subject = str(msg.get('Subject'))
-        content = str(msg.get_payload())
-        smsmsg = "{} {}\n{}".format(sender, subject, content)
+        content = extractor.text()
+        smsmsg = self.planner.plan("{} {}\n{}".format(sender, subject, content))
+        return smsmsg, scheduler.header_priority(msg), scheduler.header_deadline(msg)
+
+    async def summarize(self):
+        """Sends the summaries of what storm control held back"""
+        while True:
+            storm = self.storm
+            await asyncio.sleep(min(storm.window / 10, 10) if storm is not None else 10)
+            if storm is None or storm is not self.storm:
+                continue
+            priority = self.queue.default
+            for number, text in storm.summaries():
+                self.logger.info("Summary to {}: {}".format(number, text))
+                metrics.summaries.inc()
+                await self.submit([(number, priority, self.queue.deadline(priority), None)], self.planner.plan(text))
+
+    async def process_messages(self, peer, mailfrom, rcpttos, data):
+        """Parses and encodes the message once for all recipients, with
+        groups expanded into the same submission"""
+        addresses = [self.recipient(rcptto) for rcptto in rcpttos]
+        statuses = [None] * len(addresses)
+
+        self.logger.info("Process message to {}:".format(", ".join(
+            rcptto.decode("ascii", errors="replace") for rcptto in rcpttos)))
+
+        # (number, extension), a number in several groups goes out once
+        # with the extension of the first, and each recipient's status
+        # comes from all of its numbers
+        expanded = []
+        seen = set()
+        members = {}
+        for n, address in enumerate(addresses):
+            if address is None:
+                self.logger.error("Not an ASCII address: {!r}".format(rcpttos[n]))
+                statuses[n] = "550 5.1.3 Bad recipient address syntax"
+                metrics.rejects.inc()
+                continue
+            name, extension = address
+            numbers = self.resolve(name)
+            if numbers is None and not self.directory.loaded():
+                self.logger.error("No directory to look up {} in".format(name))
+                statuses[n] = "451 4.3.0 Directory not available, try again later"
+                metrics.tempfails.inc()
+                continue
+            if numbers is None:
+                self.logger.error("{} is not in the directory".format(name))
+                statuses[n] = "550 5.1.1 Unknown recipient {}".format(name)
+                metrics.rejects.inc()
+                continue
+            if not numbers:
+                self.logger.error("{} has no numbers".format(name))
+                statuses[n] = "550 5.1.1 No numbers for {}".format(name)
+                metrics.rejects.inc()
+                continue
+            members[n] = numbers
+            for number in numbers:
+                if number not in seen:
+                    seen.add(number)
+                    expanded.append((number, extension))
+        if not expanded:
+            return statuses
+
+        smsmsg, priority, deadline = self.extract(data)
+
+        # the address extension wins over the headers
+        accepted = time.time()
+        recipients = []
+        for number, extension in expanded:
+            if extension in scheduler.CLASSES:
+                recipientpriority = scheduler.CLASSES[extension]
+            else:
+                if extension is not None:
+                    self.logger.warning("Unknown priority class {} for {}".format(extension, number))
+                recipientpriority = self.queue.default if priority is None else priority
+            recipients.append((number, recipientpriority, deadline or self.queue.deadline(recipientpriority, accepted), None))
+
+        if self.storm is None:
+            admitted = list(range(len(recipients)))
+        else:
+            # duplicates are dropped, anything else over the rates is
+            # spooled to go out later
+            admitted = []
+            for i, (number, recipientpriority, recipientdeadline, notbefore) in enumerate(recipients):
+                delay = self.storm.admit(number, smsmsg)
+                if delay is None:
+                    continue
+                if delay > 0:
+                    recipients[i] = (number, recipientpriority, recipientdeadline, accepted + delay)
+                    metrics.deferred.inc()
+                admitted.append(i)
+            if len(admitted) < len(recipients):
+                self.logger.info("Storm control held back {} of {} recipients".format(len(recipients) - len(admitted), len(recipients)))
+                metrics.suppressed.inc(len(recipients) - len(admitted))
+        results = [None] * len(recipients)
+        if admitted:
+            for i, status in zip(admitted, await self.submit([recipients[i] for i in admitted], smsmsg)):
+                results[i] = status
+
+        # a group is delivered if any of its numbers was, so the client
+        # does not retry the whole group for one bad number
+        results = {number: status for (number, extension), status in zip(expanded, results)}
+        for n, numbers in members.items():
+            if all(results[number] is not None for number in numbers):
+                statuses[n] = results[numbers[0]]
+        return statuses
 
-        textmessage = TextMessage(number, smsmsg)
-        # TODO implement chaining parts
-        pdumessage = list(textmessage.parts())[0]
+    async def submit(self, recipients, smsmsg):
+        """Encodes and spools smsmsg to (number, priority, deadline,
+        notbefore) recipients, one LMTP status per recipient"""
+        statuses = [None] * len(recipients)
+        messages = []
+        template = None
+        with metrics.encode_seconds.time():
+            for n, (number, priority, deadline, notbefore) in enumerate(recipients):
+                try:
+                    textmessage = TextMessage(number, smsmsg)
+                    pdumessages = list(textmessage.parts(template))
+                except ValueError as e:
+                    self.logger.error("{}: {}".format(number, e))
+                    statuses[n] = "550 5.1.1 {}".format(e)
+                    metrics.rejects.inc()
+                    continue
+                template = pdumessages
+                messages.append((n, number, pdumessages, priority, deadline, notbefore))
 
         try:
-            self.smsdevice.sendpdusms(pdumessage)
+            entries = await asyncio.get_running_loop().run_in_executor(None, self.spool.add, [message[1:] for message in messages])
         except Exception as e:
             self.logger.error("{}".format(e))
-            self.smsdevice.disconnect()
-            return "450 {}".format(e).encode("UTF-8", errors='ignore')
-        return None
+            for message in messages:
+                statuses[message[0]] = "451 4.3.0 {}".format(e)
+            metrics.tempfails.inc(len(messages))
+            return statuses
+        metrics.messages.inc(len(entries))
+        # the scheduler takes turns between numbers within each priority class
+        for entry in entries:
+            self.enqueue(entry)
+        return statuses
 
+    async def process_message(self, peer, mailfrom, rcptto, data):
+        return (await self.process_messages(peer, mailfrom, [rcptto], data))[0]
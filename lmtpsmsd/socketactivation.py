@@ -24,31 +24,43 @@
 
 from __future__ import print_function, unicode_literals
 
-__all__ = ["get_activation_socket"]
+__all__ = ["get_activation_socket", "get_activation_sockets"]
 
+import os
 import socket
 
-from systemd.daemon import is_socket,is_socket_unix,is_socket_inet
+from systemd.daemon import is_socket,is_socket_unix
 from systemd.daemon import listen_fds
 
-def get_activation_socket():
-    def sock_from_fd(fd):
-        if is_socket(fd):
-            if is_socket_unix(fd):
-                return socket.socket(family=socket.AF_UNIX, type=socket.SOCK_STREAM, fileno=fd)
-            for fam in [socket.AF_INET6, socket.AF_INET]:
-                for t in [socket.SOCK_STREAM]:
-                    if is_socket(fd, family=fam, type=t):
-                        return socket.socket(family=fam, type=t, fileno=fd)
-            return socket.socket(fileno=fd)
-        return None
+def sock_from_fd(fd):
+    if is_socket(fd):
+        if is_socket_unix(fd):
+            return socket.socket(family=socket.AF_UNIX, type=socket.SOCK_STREAM, fileno=fd)
+        for fam in [socket.AF_INET6, socket.AF_INET]:
+            for t in [socket.SOCK_STREAM]:
+                if is_socket(fd, family=fam, type=t):
+                    return socket.socket(family=fam, type=t, fileno=fd)
+        return socket.socket(fileno=fd)
+    return None
 
+def get_activation_sockets():
+    """All activation sockets as (name, socket), named by FileDescriptorName="""
+    # listen_fds() unsets the environment, names included
+    names = os.environ.get("LISTEN_FDNAMES", "").split(":")
     fds = listen_fds()
-    if len(fds) != 1:
-        raise Exception("socket activation required")
-    sock = sock_from_fd(fds[0])
-    if not sock:
+    if not fds:
         raise Exception("socket activation required")
+    socks = []
+    for i, fd in enumerate(fds):
+        sock = sock_from_fd(fd)
+        if not sock:
+            raise Exception("activation fd {} is not a socket".format(fd))
+        name = names[i] if i < len(names) and names[i] else "fd{}".format(fd)
+        socks.append((name, sock))
+    return socks
 
-    return sock
-
+def get_activation_socket():
+    socks = get_activation_sockets()
+    if len(socks) != 1:
+        raise Exception("socket activation required")
+    return socks[0][1]
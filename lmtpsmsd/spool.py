@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+__all__ = ["Spool"]
+
+import os
+import json
+import time
+import itertools
+import logging
+
+from ._private.scheduler import NORMAL
+
+# Each queued message is one append-only journal file. The first record
+# holds the encoded PDUs, each part that the modem has accepted gets a
+# "sent" record appended, and the file is removed once all parts are
+# out. Every record is fsync'd before it is relied upon.
+
+class SpooledPDU():
+    """Stands in for SMSC_and_TPDU once the PDU has been encoded"""
+    def __init__(self, hexstr, tpdu_octet_length):
+        self.hexstr = hexstr
+        self.octets = tpdu_octet_length
+
+    def hex(self):
+        return self.hexstr
+
+    def tpdu_octet_length(self):
+        return self.octets
+
+class SpoolEntry():
+    def __init__(self, name, number, parts, sent=(), priority=NORMAL, deadline=None, notbefore=None):
+        self.name = name
+        self.number = number
+        self.parts = parts
+        self.sent = set(sent)
+        self.attempts = 0
+        self.priority = priority
+        self.deadline = deadline
+        # held back by the rate limits until then
+        self.notbefore = notbefore
+
+    def done(self):
+        return len(self.sent) == len(self.parts)
+
+    def expired(self, now=None):
+        return self.deadline is not None and (time.time() if now is None else now) > self.deadline
+
+    def unsent(self):
+        for i, part in enumerate(self.parts):
+            if i not in self.sent:
+                yield i, part
+
+class Spool():
+    def __init__(self, spoolconf):
+        self.directory = spoolconf["directory"]
+        self.maxattempts = int(spoolconf.get("maxattempts", 10))
+        self.faileddirectory = os.path.join(self.directory, "failed")
+        self.logger = logging.getLogger("spool")
+        self.sequence = itertools.count()
+        os.makedirs(self.faileddirectory, exist_ok=True)
+
+    def configure(self, spoolconf):
+        """On reload, the directory itself only changes with a restart"""
+        if spoolconf["directory"] != self.directory:
+            self.logger.warning("Spool directory {} takes effect after a restart".format(spoolconf["directory"]))
+        self.maxattempts = int(spoolconf.get("maxattempts", 10))
+
+    def path(self, name, suffix=".journal"):
+        return os.path.join(self.directory, name + suffix)
+
+    def syncdir(self, directory=None):
+        fd = os.open(directory or self.directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def append(self, name, record):
+        with open(self.path(name), "ab") as f:
+            f.write(json.dumps(record).encode("ascii") + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def write(self, number, pdumessages, priority=NORMAL, deadline=None, notbefore=None):
+        name = "{:020d}-{:06d}".format(time.time_ns(), next(self.sequence) % 1000000)
+        parts = [SpooledPDU(p.hex(), p.tpdu_octet_length()) for p in pdumessages]
+        record = {"queued": {"number": number, "parts": [[p.hex(), p.tpdu_octet_length()] for p in parts],
+                             "priority": priority, "deadline": deadline, "notbefore": notbefore}}
+        tmp = self.path(name, ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(json.dumps(record).encode("ascii") + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path(name))
+        return SpoolEntry(name, number, parts, priority=priority, deadline=deadline, notbefore=notbefore)
+
+    def add(self, messages):
+        """Durably queue (number, pdumessages[, priority, deadline, notbefore]) tuples,
+        returns once they are on disk"""
+        entries = [self.write(*message) for message in messages]
+        # one directory sync covers all the renames
+        self.syncdir()
+        return entries
+
+    def mark_sent(self, entry, index):
+        self.append(entry.name, {"sent": index})
+        entry.sent.add(index)
+        if entry.done():
+            self.complete(entry)
+
+    def complete(self, entry):
+        os.unlink(self.path(entry.name))
+        self.syncdir()
+
+    def fail(self, entry):
+        os.rename(self.path(entry.name), os.path.join(self.faileddirectory, entry.name + ".journal"))
+        self.syncdir(self.faileddirectory)
+        self.syncdir()
+
+    def load(self, name):
+        with open(self.path(name), "r+b") as f:
+            data = f.read()
+            # A torn last record is cut off so later appends start on a
+            # fresh line, that part will be sent again.
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                f.truncate(end)
+                os.fsync(f.fileno())
+        entry = None
+        for line in data[:end].split(b"\n"):
+            try:
+                record = json.loads(line.decode("ascii"))
+            except ValueError:
+                continue
+            if "queued" in record:
+                queued = record["queued"]
+                parts = [SpooledPDU(h, l) for h, l in queued["parts"]]
+                entry = SpoolEntry(name, queued["number"], parts,
+                                   priority=queued.get("priority", NORMAL), deadline=queued.get("deadline"),
+                                   notbefore=queued.get("notbefore"))
+            elif "sent" in record and entry is not None:
+                entry.sent.add(record["sent"])
+        return entry
+
+    def recover(self):
+        """Returns the entries left over from a previous run, oldest first"""
+        entries = []
+        for filename in sorted(os.listdir(self.directory)):
+            if filename.endswith(".tmp"):
+                # never acknowledged to the MTA
+                os.unlink(os.path.join(self.directory, filename))
+                continue
+            if not filename.endswith(".journal"):
+                continue
+            name = filename[:-len(".journal")]
+            entry = self.load(name)
+            if entry is None:
+                self.logger.error("Unreadable spool file {}".format(filename))
+                os.rename(self.path(name), os.path.join(self.faileddirectory, filename))
+                continue
+            if entry.done():
+                self.complete(entry)
+                continue
+            entries.append(entry)
+        if entries:
+            self.logger.info("Recovered {} spooled messages".format(len(entries)))
+        return entries
+
@@ -18,6 +18,6 @@ setuptools.setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.6',
-    scripts=['bin/lmtpsmsd'],
+    python_requires='>=3.7',
+    scripts=['bin/lmtpsmsd', 'bin/lmtpsmsd-bulk'],
 )
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+from lmtpsmsd._private.atresponse import ATResponseParser, ATEvent, FINAL, INTERMEDIATE, UNSOLICITED, PROMPT
+
+def test_final_and_intermediate():
+    parser = ATResponseParser()
+    parser.expect(("+CSQ",))
+    assert parser.feed(b"AT+CSQ\r\r\n+CSQ: 20,99\r\n\r\nOK\r\n") == [
+        ATEvent(INTERMEDIATE, "+CSQ: 20,99"), ATEvent(FINAL, "OK")]
+
+def test_error_results_are_final():
+    parser = ATResponseParser()
+    assert parser.feed(b"\r\n+CMS ERROR: 331\r\n\r\nERROR\r\n") == [
+        ATEvent(FINAL, "+CMS ERROR: 331"), ATEvent(FINAL, "ERROR")]
+
+def test_unsolicited_between_responses():
+    parser = ATResponseParser()
+    parser.expect(("+CPIN",))
+    assert parser.feed(b"\r\n+CREG: 5\r\n+CPIN: READY\r\nRING\r\nOK\r\n") == [
+        ATEvent(UNSOLICITED, "+CREG: 5"), ATEvent(INTERMEDIATE, "+CPIN: READY"),
+        ATEvent(UNSOLICITED, "RING"), ATEvent(FINAL, "OK")]
+
+def test_unprefixed_text_is_intermediate():
+    parser = ATResponseParser()
+    assert parser.feed(b"AT+CGMI\r\nACME\r\nOK\r\n") == [ATEvent(INTERMEDIATE, "ACME"), ATEvent(FINAL, "OK")]
+
+def test_prompt_without_line_ending():
+    parser = ATResponseParser()
+    assert parser.feed(b"AT+CMGS=23\r\r\n> ") == [ATEvent(PROMPT, "> ")]
+    parser.expect(("+CMGS",))
+    assert parser.feed(b"\r\n+CMGS: 12\r\n\r\nOK\r\n") == [ATEvent(INTERMEDIATE, "+CMGS: 12"), ATEvent(FINAL, "OK")]
+
+def test_lines_split_across_reads():
+    parser = ATResponseParser()
+    assert parser.feed(b"\r\nO") == []
+    assert parser.feed(b"K\r") == []
+    assert parser.feed(b"\n\r\n+CME ER") == [ATEvent(FINAL, "OK")]
+    assert parser.feed(b"ROR: 10\r\n") == [ATEvent(FINAL, "+CME ERROR: 10")]
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+from __future__ import print_function, unicode_literals
+
+from lmtpsmsd._private.commandtimeouts import (
+    CommandTimeouts, LatencyEstimate, DEFAULT, LIMITS, commandtype)
+
+def test_commandtype_drops_the_arguments():
+    assert commandtype("AT+CREG?") == "AT+CREG?"
+    assert commandtype("AT+CREG=1") == "AT+CREG="
+    assert commandtype("AT+CPIN=\"1234\"") == "AT+CPIN="
+    assert commandtype("ATE0") == "ATE0"
+
+def test_estimate_follows_the_measurements():
+    estimate = LatencyEstimate(3.0, 1.0, 15.0)
+    assert estimate.timeout == 3.0
+    estimate.observe(0.2)
+    # srtt 0.2, rttvar 0.1, kept above the minimum
+    assert estimate.timeout == 1.0
+    for i in range(50):
+        estimate.observe(4.0)
+    assert 4.0 < estimate.timeout < 15.0
+    estimate.observe(100.0)
+    assert estimate.timeout == 15.0
+
+def test_timeout_backs_off_up_to_the_maximum():
+    estimate = LatencyEstimate(3.0, 1.0, 15.0)
+    estimate.timedout()
+    assert estimate.timeout == 6.0
+    estimate.timedout()
+    estimate.timedout()
+    assert estimate.timeout == 15.0
+    estimate.observe(0.5)
+    assert estimate.timeout < 15.0
+
+def test_limits_per_command_type():
+    timeouts = CommandTimeouts()
+    assert timeouts["AT+CMGS prompt"].timeout == LIMITS["AT+CMGS prompt"][0]
+    assert timeouts["AT+CPIN="].maximum == LIMITS["AT+CPIN="][2]
+    assert timeouts["AT+CSQ"].timeout == DEFAULT[0]
+    assert timeouts["AT+CSQ"] is timeouts["AT+CSQ"]
+    assert sorted(kind for kind, estimate in timeouts.items()) == ["AT+CMGS prompt", "AT+CPIN=", "AT+CSQ"]
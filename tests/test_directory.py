@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+from __future__ import print_function, unicode_literals
+
+import os
+import logging
+
+from lmtpsmsd._private.directory import Directory, DirectoryIndex, build
+
+SOURCE = """\
+# people
+alice: +46701111111, +46702222222
+Bob: 46703333333
+oncall: alice, bob, +46701111111
+everyone: oncall, night
+night: everyone, +46704444444
+broken: 12x
+"""
+
+def write(path, text):
+    with open(str(path), "w") as f:
+        f.write(text)
+
+def test_groups_flatten_in_order(tmpdir):
+    source = tmpdir.join("directory")
+    write(source, SOURCE)
+    assert build(str(source), str(tmpdir.join("index"))) == 6
+    index = DirectoryIndex(str(tmpdir.join("index")))
+    assert len(index) == 6
+    assert index.lookup("alice") == ["+46701111111", "+46702222222"]
+    assert index.lookup("BOB") == ["46703333333"]
+    assert index.lookup("oncall") == ["+46701111111", "+46702222222", "46703333333"]
+    assert index.lookup("nobody") is None
+    assert index.lookup("broken") == []
+
+def test_groups_that_hold_each_other(tmpdir):
+    source = tmpdir.join("directory")
+    write(source, SOURCE)
+    build(str(source), str(tmpdir.join("index")))
+    index = DirectoryIndex(str(tmpdir.join("index")))
+    assert sorted(index.lookup("everyone")) == sorted(index.lookup("night"))
+    assert "+46704444444" in index.lookup("everyone")
+
+def test_bad_members_are_logged(tmpdir, caplog):
+    source = tmpdir.join("directory")
+    write(source, SOURCE)
+    with caplog.at_level(logging.WARNING):
+        build(str(source), str(tmpdir.join("index")))
+    assert "12x in broken" in caplog.text
+
+def test_refresh_recompiles_on_change(tmpdir):
+    source = tmpdir.join("directory")
+    write(source, "alice: +46701111111\n")
+    directory = Directory({"source": str(source)})
+    assert directory.lookup("alice") is None
+    assert directory.stale()
+    assert directory.refresh()
+    assert directory.lookup("alice") == ["+46701111111"]
+    assert not directory.stale()
+    assert not directory.refresh()
+    write(source, "alice: +46702222222\n")
+    mtime = os.stat(str(source)).st_mtime
+    os.utime(str(source), (mtime + 10, mtime + 10))
+    assert directory.stale()
+    assert directory.refresh()
+    assert directory.lookup("alice") == ["+46702222222"]
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+from lmtpsmsd._private.lrucache import LRUCache
+
+def test_least_recently_used_goes_first():
+    cache = LRUCache(2, 1000)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    assert cache.get("a") == "1"
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+    assert cache.stats() == {"entries": 2, "bytes": 4, "hits": 3, "misses": 1}
+
+def test_bounded_in_bytes():
+    cache = LRUCache(100, 10)
+    cache.put("a", "1234")
+    cache.put("b", "1234")
+    assert len(cache) == 2
+    cache.put("c", "1234")
+    assert cache.get("a") is None
+    assert cache.bytes == 10
+    # larger than the whole cache, never kept
+    cache.put("d", "x" * 20)
+    assert cache.get("d") is None
+    assert len(cache) == 2
+
+def test_replacing_a_value_updates_the_size():
+    cache = LRUCache(10, 100)
+    cache.put("a", "1234")
+    cache.put("a", "12")
+    assert cache.bytes == 3
+    assert cache.get("a") == "12"
+
+def test_configure_shrinks_and_disables():
+    cache = LRUCache(10, 100)
+    for key in "abcde":
+        cache.put(key, "1")
+    cache.configure(2, 100)
+    assert [key for key in "abcde" if cache.get(key) is not None] == ["d", "e"]
+    cache.configure(0, 100)
+    cache.put("f", "1")
+    assert len(cache) == 0
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+import base64
+
+from lmtpsmsd._private.mimeextract import MIMEExtractor
+
+def extract(message, maxchars=160):
+    extractor = MIMEExtractor(maxchars)
+    for line in message.split(b"\n"):
+        extractor.feed(line.rstrip(b"\r"))
+    return extractor.close()
+
+MULTIPART = b"""From: nagios@example.com
+Subject: =?utf-8?q?V=C3=A4rme?=
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="outer"
+
+preamble
+--outer
+Content-Type: multipart/alternative; boundary="inner"
+
+--inner
+Content-Type: text/plain; charset=iso-8859-1
+Content-Transfer-Encoding: quoted-printable
+
+V=E4rmen =
+=E4r p=E5
+--inner
+Content-Type: text/html
+
+<p>ignored</p>
+--inner--
+--outer
+Content-Type: text/plain
+Content-Disposition: attachment
+
+not this one
+--outer--
+"""
+
+def test_first_text_part_of_multipart():
+    extractor = extract(MULTIPART.replace(b"\n", b"\r\n"))
+    assert extractor.headers["Subject"] == "Värme"
+    assert extractor.text() == "Värmen är på"
+
+def test_attachment_is_skipped():
+    message = MULTIPART.replace(b"Content-Type: text/plain; charset=iso-8859-1", b"Content-Type: text/csv")
+    assert extract(message).text() == ""
+
+def test_oversized_base64_body_is_cut():
+    body = base64.encodebytes(("€" * 100000).encode("utf-8"))
+    message = b"Subject: big\nContent-Type: text/plain; charset=utf-8\nContent-Transfer-Encoding: base64\n\n" + body
+    extractor = extract(message, maxchars=10)
+    assert extractor.text() == "€" * 10
+    # only what could make up maxchars was decoded
+    assert len(extractor.body) <= 4 * 10 + 57
+
+def test_no_blank_line_after_headers():
+    extractor = extract(b"Subject: only headers", maxchars=10)
+    assert extractor.headers["Subject"] == "only headers"
+    assert extractor.text() == ""
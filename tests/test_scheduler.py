@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+import asyncio
+import collections
+import email.message
+
+import pytest
+
+from lmtpsmsd._private.scheduler import Scheduler, URGENT, HIGH, NORMAL, BULK, header_priority, split_extension
+
+Entry = collections.namedtuple("Entry", ["number", "priority", "text"])
+
+def drain(scheduler):
+    entries = []
+    while not scheduler.empty():
+        entries.append(scheduler.get_nowait())
+    return entries
+
+def test_higher_classes_first():
+    scheduler = Scheduler()
+    for priority in (BULK, NORMAL, URGENT, HIGH, NORMAL):
+        scheduler.put_nowait(Entry("+4670", priority, str(priority)))
+    assert scheduler.sizes() == {"urgent": 1, "high": 1, "normal": 2, "bulk": 1}
+    assert [entry.priority for entry in drain(scheduler)] == [URGENT, HIGH, NORMAL, NORMAL, BULK]
+    with pytest.raises(asyncio.QueueEmpty):
+        scheduler.get_nowait()
+
+def test_round_robin_within_a_class():
+    scheduler = Scheduler()
+    for text in "abc":
+        scheduler.put_nowait(Entry("+4670", NORMAL, text))
+    scheduler.put_nowait(Entry("+4671", NORMAL, "d"))
+    scheduler.put_nowait(Entry("+4672", NORMAL, "e"))
+    assert [entry.text for entry in drain(scheduler)] == ["a", "d", "e", "b", "c"]
+
+def test_urgent_overtakes_waiting_bulk():
+    scheduler = Scheduler()
+    for n in range(3):
+        scheduler.put_nowait(Entry("+467{}".format(n), BULK, "bulk"))
+    assert scheduler.get_nowait().priority == BULK
+    scheduler.put_nowait(Entry("+4679", URGENT, "page"))
+    assert scheduler.get_nowait().text == "page"
+    assert scheduler.qsize() == 2
+
+def test_deadline_per_class():
+    scheduler = Scheduler({"bulk": "3600"})
+    assert scheduler.deadline(BULK, accepted=1000) == 4600
+    assert scheduler.deadline(URGENT, accepted=1000) is None
+
+def test_header_priority():
+    msg = email.message.EmailMessage()
+    assert header_priority(msg) is None
+    msg["Precedence"] = "bulk"
+    assert header_priority(msg) == BULK
+    msg["Importance"] = "High"
+    assert header_priority(msg) == HIGH
+    msg["X-Priority"] = "1 (Highest)"
+    assert header_priority(msg) == URGENT
+
+def test_split_extension():
+    assert split_extension("+46701234567+urgent") == ("+46701234567", "urgent")
+    assert split_extension("+46701234567") == ("+46701234567", None)
+    assert split_extension("oncall+Bulk") == ("oncall", "bulk")
+
+def test_nextpriority():
+    scheduler = Scheduler()
+    assert scheduler.nextpriority() is None
+    scheduler.put_nowait(Entry("+4670", BULK, "a"))
+    assert scheduler.nextpriority() == BULK
+    scheduler.put_nowait(Entry("+4671", HIGH, "b"))
+    assert scheduler.nextpriority() == HIGH
+
+def test_putback_keeps_the_order():
+    scheduler = Scheduler()
+    for text in "abcd":
+        scheduler.put_nowait(Entry("+4670", BULK, text))
+    scheduler.put_nowait(Entry("+4671", BULK, "e"))
+    taken = [scheduler.get_nowait(), scheduler.get_nowait(), scheduler.get_nowait()]
+    assert [entry.text for entry in taken] == ["a", "e", "b"]
+    scheduler.putback(taken[1:])
+    assert [entry.text for entry in drain(scheduler)] == ["e", "b", "c", "d"]
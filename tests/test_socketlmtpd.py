@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+import asyncio
+import socket
+
+from lmtpsmsd._private.socketlmtpd import LMTPSocketServer
+
+class Server(LMTPSocketServer):
+    async def process_message(self, peer, mailfrom, rcptto, data):
+        if rcptto == b"bug@sms":
+            raise RuntimeError("bug")
+        if rcptto == b"nobody@sms":
+            return "550 5.1.1 Unknown recipient"
+        return None
+
+def session(tmp_path, commands, maxsize=0):
+    """Replies to commands sent in one go, as a pipelining client would"""
+    async def run():
+        sock = socket.socket(socket.AF_UNIX)
+        sock.bind(str(tmp_path / "lmtp"))
+        server = Server(sock, maxsize=maxsize)
+        await server.start()
+        reader, writer = await asyncio.open_unix_connection(str(tmp_path / "lmtp"))
+        writer.write(b"".join(command + b"\r\n" for command in commands))
+        replies = (await reader.read()).decode().split("\r\n")
+        writer.close()
+        return [reply[:3] for reply in replies if reply and reply[3:4] != "-"]
+    return asyncio.run(run())
+
+MESSAGE = [b"DATA", b"Subject: x", b"", b"..dot", b"."]
+
+def test_one_reply_per_recipient(tmp_path):
+    replies = session(tmp_path, [b"LHLO client", b"MAIL FROM:<a@b>", b"RCPT TO:<x@sms>",
+                                 b"RCPT TO:<nobody@sms>"] + MESSAGE + [b"QUIT"])
+    assert replies == ["220", "250", "250", "250", "250", "354", "250", "550", "221"]
+
+def test_error_in_processing_keeps_the_session(tmp_path):
+    replies = session(tmp_path, [b"LHLO client", b"MAIL FROM:<a@b>", b"RCPT TO:<bug@sms>",
+                                 b"RCPT TO:<x@sms>"] + MESSAGE + [b"NOOP", b"QUIT"])
+    assert replies == ["220", "250", "250", "250", "250", "354", "451", "451", "250", "221"]
+
+def test_size_limit(tmp_path):
+    replies = session(tmp_path, [b"LHLO client", b"MAIL FROM:<a@b> SIZE=100000", b"MAIL FROM:<a@b> SIZE=10",
+                                 b"RCPT TO:<x@sms>", b"DATA", b"x" * 200, b".", b"QUIT"], maxsize=100)
+    assert replies == ["220", "250", "552", "250", "250", "354", "552", "221"]
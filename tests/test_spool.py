@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+from lmtpsmsd.spool import Spool, SpooledPDU
+from lmtpsmsd._private.scheduler import NORMAL
+
+def spool(tmp_path):
+    return Spool({"directory": str(tmp_path)})
+
+def queue(tmp_path):
+    parts = [SpooledPDU("0011", 2), SpooledPDU("0022", 2), SpooledPDU("0033", 2)]
+    entry, = spool(tmp_path).add([("+46701234567", parts, NORMAL, None, 123.0)])
+    return entry
+
+def test_recover_unsent_parts(tmp_path):
+    entry = queue(tmp_path)
+    spool(tmp_path).mark_sent(entry, 0)
+    recovered, = spool(tmp_path).recover()
+    assert recovered.name == entry.name
+    assert recovered.number == "+46701234567"
+    assert recovered.notbefore == 123.0
+    assert [i for i, part in recovered.unsent()] == [1, 2]
+
+def test_recover_after_torn_record(tmp_path):
+    entry = queue(tmp_path)
+    s = spool(tmp_path)
+    s.mark_sent(entry, 0)
+    # the process died in the middle of appending the next record
+    with open(s.path(entry.name), "ab") as f:
+        f.write(b'{"sent": ')
+    recovered, = spool(tmp_path).recover()
+    assert recovered.sent == {0}
+    # later records go on a line of their own
+    s.mark_sent(recovered, 1)
+    assert spool(tmp_path).recover()[0].sent == {0, 1}
+
+def test_recover_completes_and_cleans_up(tmp_path):
+    entry = queue(tmp_path)
+    s = spool(tmp_path)
+    for index in range(3):
+        s.mark_sent(entry, index)
+    open(s.path("unacknowledged", ".tmp"), "wb").close()
+    assert spool(tmp_path).recover() == []
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["failed"]
+
+def test_unreadable_journal_is_moved_aside(tmp_path):
+    s = spool(tmp_path)
+    with open(s.path("garbage"), "wb") as f:
+        f.write(b"not json\n")
+    assert s.recover() == []
+    assert (tmp_path / "failed" / "garbage.journal").exists()
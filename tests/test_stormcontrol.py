@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+import pytest
+
+from lmtpsmsd._private.stormcontrol import StormControl, TokenBucket
+
+def test_bucket_delay_grows_past_the_burst():
+    bucket = TokenBucket(2, 0)
+    bucket.refill(1, 2, 0)
+    assert [bucket.take(1) for i in range(4)] == [0, 0, 1, 2]
+    bucket.refill(1, 2, 10)
+    assert bucket.tokens == 2
+
+def test_duplicates_are_suppressed_and_summarized():
+    storm = StormControl({"window": 60})
+    assert storm.admit("+4670", "Disk 91% full", now=0) == 0
+    assert storm.admit("+4670", "disk  93% FULL", now=1) is None
+    assert storm.admit("+4671", "Disk 91% full", now=2) == 0
+    assert list(storm.summaries(now=30)) == []
+    assert list(storm.summaries(now=61)) == [("+4670", "(1 more similar) disk  93% FULL")]
+
+def test_destination_rate_delays_instead_of_dropping():
+    storm = StormControl({"destrate": 0.5, "destburst": 2, "globalburst": 100})
+    delays = [storm.admit("+4670", "message {}".format(c), now=0) for c in "abcd"]
+    assert delays == [0, 0, pytest.approx(2), pytest.approx(4)]
+    # other numbers have buckets of their own
+    assert storm.admit("+4671", "message a", now=0) == 0
+
+def test_global_rate():
+    storm = StormControl({"globalrate": 2, "globalburst": 1})
+    assert [storm.admit("+467{}".format(n), "x", now=0) for n in range(3)] == [0, pytest.approx(0.5), pytest.approx(1)]
+    assert storm.admit("+4679", "x", now=10) == 0
+
+def test_bounded_index():
+    storm = StormControl({"maxentries": 2, "window": 60})
+    for n in range(5):
+        storm.admit("+467{}".format(n), "x", now=0)
+    assert len(storm.index) == 2
+    assert len(storm.buckets) == 2
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kungliga Tekniska högskolan
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function, unicode_literals
+
+import smsutil
+
+from lmtpsmsd._private.textplan import TextPlanner, compact, transliterate
+
+def test_gsm_text_is_kept():
+    assert TextPlanner()("Disk full på srv-1, 95% [sda]") == "Disk full på srv-1, 95% [sda]"
+
+def test_typography_is_transliterated():
+    assert TextPlanner()("“Backup” failed – see log…") == '"Backup" failed - see log...'
+
+def test_accents_stay_in_ucs2_when_it_costs_nothing():
+    assert TextPlanner()("Citroën") == "Citroën"
+
+def test_accents_go_when_ucs2_needs_more_segments():
+    text = "Citroën " + "x" * 100
+    assert TextPlanner()(text) == "Citroen " + "x" * 100
+
+def test_other_scripts_stay_in_ucs2():
+    assert TextPlanner()("Сервер недоступен") == "Сервер недоступен"
+    assert transliterate("Сервер") is None
+    assert TextPlanner(transliterate=False)("“x”") == "“x”"
+
+def test_truncated_at_a_word_to_the_budget():
+    text = " ".join("word{}".format(n) for n in range(100))
+    planned = TextPlanner(maxsegments=1)(text)
+    assert planned.endswith("...")
+    assert len(planned) <= 160
+    assert planned[:-3].split(" ")[-1].startswith("word")
+    assert text.startswith(planned[:-3])
+
+def test_truncated_ucs2_fits_the_segments():
+    planned = TextPlanner(maxsegments=2)("Сервер недоступен " * 30)
+    assert planned.endswith("…")
+    assert len(smsutil.split(planned).parts) == 2
+
+def test_compact():
+    assert compact("  a   b \n\n\n c\n-- \nSignature\n") == "a b\nc"